@@ -7,19 +7,36 @@ import streamlit as st
 import streamlit.components.v1 as components
 import pandas as pd
 import numpy as np
-from datetime import date, timedelta
+import os
+import json
+import shutil
+import pyarrow as pa
+import pyarrow.dataset as pa_ds
+import pyarrow.parquet as pq
+from datetime import date, datetime, timedelta, timezone
 from FinMind.data import DataLoader
 from scipy.stats import norm
+from scipy.special import ndtr
 import plotly.graph_objects as go
 import plotly.express as px
+from plotly.subplots import make_subplots
 
 import feedparser
+import holidays
+import asyncio
 import time
-from collections import Counter
+import threading
+import bisect
+from time import monotonic
+from collections import Counter, OrderedDict
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from wordcloud import WordCloud
+from sim_workers import simulate_month, mc_chunk
 import matplotlib.pyplot as plt
 import random
 import httpx
+import requests
 
 # =========================================
 # 0. 自動跳轉 JS 函數 (完美修復版，支援 jump=5)
@@ -114,20 +131,560 @@ FINMIND_TOKEN = st.secrets.get("FINMIND_TOKEN", st.secrets.get("finmind_token",
 # =========================================
 # 2. 核心函數庫 (全數保留)
 # =========================================
+# ---- FinMind 共用閘道：全站只登入一次，共用連線池 ----
+FINMIND_RELOGIN_SEC = 6 * 3600   # token 定期重新驗證
+FINMIND_POOL_SIZE = 16           # 與並行抓取的執行緒數對齊
+
+class FinMindGateway:
+    """全站共用的 FinMind 客戶端。
+
+    用法與 DataLoader 相同 (dl.taiwan_stock_daily(...))；底層只保留一個已登入的
+    DataLoader，token 逾時或 API 回報授權錯誤時自動重新登入並重試一次。
+    """
+
+    def __init__(self, token):
+        self.token = token
+        self._lock = threading.Lock()
+        self._dl = None
+        self._login_at = 0.0
+
+    def _mount_pool(self, dl):
+        # DataLoader 內部的 requests.Session；放大連線池讓多執行緒共用 keep-alive
+        session = getattr(dl, "_FinMindApi__session", None)
+        if isinstance(session, requests.Session):
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=FINMIND_POOL_SIZE)
+            session.mount("https://", adapter)
+
+    def _client(self, force=False):
+        with self._lock:
+            age = monotonic() - self._login_at
+            # force 也至少間隔 60 秒，避免多執行緒同時失敗時重複登入
+            if self._dl is None or age > FINMIND_RELOGIN_SEC or (force and age > 60):
+                dl = DataLoader()
+                self._mount_pool(dl)
+                if self.token:
+                    try: dl.login_by_token(api_token=self.token)
+                    except Exception: pass  # 登入失敗仍以匿名額度繼續
+                self._dl = dl
+                self._login_at = monotonic()
+            return self._dl
+
+    @staticmethod
+    def _is_auth_error(e):
+        msg = str(e).lower()
+        return "401" in msg or "token" in msg or "login" in msg
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        attr = getattr(self._client(), name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            try:
+                return getattr(self._client(), name)(*args, **kwargs)
+            except Exception as e:
+                if not self._is_auth_error(e): raise
+                return getattr(self._client(force=True), name)(*args, **kwargs)
+        return call
+
+@st.cache_resource(show_spinner=False)
+def get_finmind(token):
+    """跨 session 共用的 FinMind 閘道 (每個 token 一個)。"""
+    return FinMindGateway(token)
+
+def run_concurrent(tasks, timeouts, on_result, max_workers=6, default_timeout=15):
+    """並行執行多個資料來源，先完成先回呼 on_result(name, value)。
+
+    tasks: {name: 無參數 callable}；timeouts: {name: 秒}。逾時或拋錯的來源直接略過，
+    on_result 只在呼叫端執行緒執行 (可安全使用 st.*)。回傳成功的來源名稱集合。
+    """
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    start = monotonic()
+    futures = {pool.submit(fn): name for name, fn in tasks.items()}
+    deadline = {f: timeouts.get(name, default_timeout) for f, name in futures.items()}
+    pending, ok = set(futures), set()
+    try:
+        while pending:
+            elapsed = monotonic() - start
+            expired = {f for f in pending if elapsed >= deadline[f]}
+            for f in expired: f.cancel()
+            pending -= expired
+            if not pending: break
+            budget = min(deadline[f] for f in pending) - elapsed
+            done, pending = wait(pending, timeout=budget, return_when=FIRST_COMPLETED)
+            for f in done:
+                try:
+                    on_result(futures[f], f.result())
+                    ok.add(futures[f])
+                except Exception:
+                    pass
+    finally:
+        # 不等逾時的執行緒收尾，讓頁面先往下跑
+        pool.shutdown(wait=False, cancel_futures=True)
+    return ok
+
+# ---- RSS 聚合：httpx 非同步並行 + ETag/Last-Modified 條件式請求 ----
+RSS_DEADLINE_SEC = 6       # 單一來源的最長等待
+RSS_KEEP_ENTRIES = 20      # 每個來源快取的最新則數
+RSS_HEADERS = {"User-Agent": "Mozilla/5.0 (BeiguBot RSS)"}
+
+@st.cache_resource(show_spinner=False)
+def get_feed_cache():
+    """url -> {"etag", "last_modified", "entries"}；跨 session 共用，304 時直接沿用。"""
+    return {"lock": threading.Lock(), "feeds": {}}
+
+def _parse_feed_entries(body):
+    feed = feedparser.parse(body)
+    return [{
+        "title": str(e.get("title", "")), "link": str(e.get("link", "#")),
+        "summary": str(e.get("summary", "")), "published": e.get("published", "N/A"),
+    } for e in feed.entries[:RSS_KEEP_ENTRIES]]
+
+async def _fetch_feed(client, url, cached, deadline):
+    headers = {}
+    if cached.get("etag"): headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"): headers["If-Modified-Since"] = cached["last_modified"]
+    resp = await asyncio.wait_for(client.get(url, headers=headers), deadline)
+    if resp.status_code == 304 and cached:
+        return cached
+    resp.raise_for_status()
+    # 只有內容有變才解析
+    return {
+        "etag": resp.headers.get("ETag"), "last_modified": resp.headers.get("Last-Modified"),
+        "entries": _parse_feed_entries(resp.content),
+    }
+
+async def _fetch_all_feeds(urls, snapshot, deadline):
+    async with httpx.AsyncClient(follow_redirects=True, timeout=deadline, headers=RSS_HEADERS) as client:
+        results = await asyncio.gather(
+            *[_fetch_feed(client, u, snapshot.get(u, {}), deadline) for u in urls],
+            return_exceptions=True,
+        )
+    return dict(zip(urls, results))
+
+def fetch_rss_feeds(sources, deadline=RSS_DEADLINE_SEC):
+    """並行抓取 {來源名稱: url}，總耗時約等於最慢的一個來源 (最多 deadline 秒)。
+
+    回傳 {來源名稱: [entry dict]}；失敗或逾時的來源沿用上次快取，沒有快取則不出現在結果中。
+    """
+    cache = get_feed_cache()
+    urls = list(dict.fromkeys(sources.values()))
+    with cache["lock"]:
+        snapshot = {u: cache["feeds"][u] for u in urls if u in cache["feeds"]}
+    # 自建 event loop：Streamlit 腳本執行緒沒有預設 loop，且 FinMind 會套用 nest_asyncio
+    loop = asyncio.new_event_loop()
+    try:
+        results = loop.run_until_complete(_fetch_all_feeds(urls, snapshot, deadline))
+    finally:
+        loop.close()
+    with cache["lock"]:
+        for u, r in results.items():
+            if isinstance(r, dict): cache["feeds"][u] = r
+    out = {}
+    for name, u in sources.items():
+        r = results.get(u)
+        feed = r if isinstance(r, dict) else snapshot.get(u)
+        if feed is not None: out[name] = feed["entries"]
+    return out
+
+# ---- 本地 Parquet 行情庫：依月份分區 (month=YYYY-MM，檔內保留 date 欄)，只補抓缺少的交易日 ----
+STORE_DIR = os.environ.get("BEIGU_STORE_DIR", os.path.join(".cache", "market_store"))
+STORE_RECHECK_SEC = 1800   # 尚未拿到當日資料時，最多每 30 分鐘問一次上游
+STORE_READY_HOUR = 15      # 台北時間 15:00 後視為當日日資料已可取得
+TW_TZ = timezone(timedelta(hours=8))
+
+# 資料集名稱 -> (抓取函數, 每次請求涵蓋的天數)
+STORE_DATASETS = {
+    "TAIEX": (lambda dl, a, b: dl.taiwan_stock_daily("TAIEX", start_date=a, end_date=b), 365),
+    "TXO": (lambda dl, a, b: dl.taiwan_option_daily("TXO", start_date=a, end_date=b), 10),
+}
+
+def _epoch_now() -> float:
+    # 注意：下方 Tab 區會 from datetime import time，覆蓋掉 time 模組，這裡不用 time.time()
+    return datetime.now(TW_TZ).timestamp()
+
+def _expected_latest_day() -> str:
+    """上游理論上已發布的最新日資料日期 (只排除週末，國定假日交給 recheck 間隔處理)。"""
+    now = datetime.now(TW_TZ)
+    d = now.date() if now.hour >= STORE_READY_HOUR else now.date() - timedelta(days=1)
+    while d.weekday() >= 5:
+        d -= timedelta(days=1)
+    return d.strftime("%Y-%m-%d")
+
+class DailyStore:
+    """單一資料集的本地日資料庫；每個月一個 Parquet 分區 (日 K 一天一列，逐日分檔會變成上千個小檔)，
+    交易日清單另存 _days.json；寫入採原子替換。"""
+
+    def __init__(self, name):
+        self.name = name
+        self.root = os.path.join(STORE_DIR, name)
+        self._lock = threading.Lock()            # meta + 每日增量
+        self._backfill_lock = threading.Lock()   # 歷史回補 (網路 I/O 期間不佔 _lock)
+        self._write_lock = threading.Lock()      # 月分區讀改寫 + 交易日清單
+        os.makedirs(self.root, exist_ok=True)
+        self._days = self._load_days()
+        self._migrate_daily_partitions()
+
+    def _meta_path(self):
+        return os.path.join(self.root, "_meta.json")
+
+    def _days_path(self):
+        return os.path.join(self.root, "_days.json")
+
+    def _read_meta(self):
+        try:
+            with open(self._meta_path(), encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    def _write_json(self, path, obj):
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(obj, f)
+        os.replace(tmp, path)
+
+    def _write_meta(self, meta):
+        self._write_json(self._meta_path(), meta)
+
+    def _month_file(self, month):
+        return os.path.join(self.root, f"month={month}", "part.parquet")
+
+    def _load_days(self):
+        try:
+            with open(self._days_path(), encoding="utf-8") as f:
+                return sorted(json.load(f))
+        except Exception:
+            # 清單遺失：只讀各月分區的 date 欄重建
+            days = set()
+            for d in os.listdir(self.root):
+                if d.startswith("month=") and os.path.exists(self._month_file(d[6:])):
+                    days.update(pq.read_table(self._month_file(d[6:]), columns=["date"]).column("date").to_pylist())
+            return sorted(days)
+
+    def _migrate_daily_partitions(self):
+        """舊版每日一個分區 (date=YYYY-MM-DD) 併入月分區後刪除；沒有舊目錄時不做事。"""
+        old = sorted(d for d in os.listdir(self.root) if d.startswith("date="))
+        if not old: return
+        frames = []
+        for d in old:
+            f = os.path.join(self.root, d, "part.parquet")
+            if os.path.exists(f):
+                frames.append(pq.read_table(f).to_pandas().assign(date=d[5:]))
+        if frames: self._write_days(pd.concat(frames, ignore_index=True))
+        for d in old:
+            shutil.rmtree(os.path.join(self.root, d), ignore_errors=True)
+
+    def dates(self):
+        with self._write_lock:
+            return list(self._days)
+
+    def _write_days(self, df):
+        """df 含 date 欄，可跨多天；依月份併入既有分區 (同一天整天覆寫)，每個月份只重寫一次。"""
+        df = df.copy()
+        df["date"] = pd.to_datetime(df["date"]).dt.strftime("%Y-%m-%d")
+        with self._write_lock:
+            for month, g in df.groupby(df["date"].str[:7]):
+                path = self._month_file(month)
+                if os.path.exists(path):
+                    old = pq.read_table(path).to_pandas()
+                    g = pd.concat([old[~old["date"].isin(g["date"])], g], ignore_index=True)
+                g = g.sort_values("date", kind="stable").reset_index(drop=True)
+                # 數值欄一律 float64，避免各分區型別不一致 (某月全是整數) 造成讀取失敗
+                for c in g.columns:
+                    if c == "date": continue
+                    if pd.api.types.is_numeric_dtype(g[c]): g[c] = g[c].astype("float64")
+                    else: g[c] = g[c].astype(str)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = os.path.join(os.path.dirname(path), ".part.parquet.tmp")   # . 開頭：寫入中的檔案不會被 dataset 掃到
+                pq.write_table(pa.Table.from_pandas(g, preserve_index=False), tmp)
+                os.replace(tmp, path)
+            self._days = sorted(set(self._days) | set(df["date"]))
+            self._write_json(self._days_path(), self._days)
+
+    def _fetch_range(self, start, end, fetch, chunk_days):
+        d0 = datetime.strptime(start, "%Y-%m-%d").date()
+        d_end = datetime.strptime(end, "%Y-%m-%d").date()
+        while d0 <= d_end:
+            d1 = min(d0 + timedelta(days=chunk_days - 1), d_end)
+            df = fetch(d0.strftime("%Y-%m-%d"), d1.strftime("%Y-%m-%d"))
+            if df is not None and not df.empty:
+                self._write_days(df)
+            d0 = d1 + timedelta(days=1)
+
+    def _fetch_back(self, start, end, fetch, chunk_days, budget):
+        """由 end 往回補到 start，最多 budget 段；回傳目前已涵蓋的最早日期。"""
+        d_start = datetime.strptime(start, "%Y-%m-%d").date()
+        d1 = datetime.strptime(end, "%Y-%m-%d").date()
+        while d1 >= d_start and budget > 0:
+            d0 = max(d1 - timedelta(days=chunk_days - 1), d_start)
+            self._fetch_range(d0.strftime("%Y-%m-%d"), d1.strftime("%Y-%m-%d"), fetch, chunk_days)
+            budget -= 1
+            d1 = d0 - timedelta(days=1)
+        return (d1 + timedelta(days=1)).strftime("%Y-%m-%d")
+
+    def put_day(self, day, df):
+        """直接寫入 (或覆寫) 單一交易日的資料，給衍生資料集用。"""
+        self._write_days(df.assign(date=day))
+
+    def covered_from(self):
+        with self._lock:
+            return self._read_meta().get("covered_from")
+
+    def backfill(self, start, fetch, chunk_days, budget):
+        """由目前最早日期往回補到 start，最多 budget 段；回傳補完後的最早日期 (已在回補中則回傳 None)。
+        只在改 meta 時短暫取 _lock，網路請求期間 sync / read 不受影響。"""
+        if not self._backfill_lock.acquire(blocking=False): return None
+        try:
+            covered_from = self.covered_from()
+            if covered_from is None or start >= covered_from: return covered_from
+            end = (datetime.strptime(covered_from, "%Y-%m-%d").date() - timedelta(days=1)).strftime("%Y-%m-%d")
+            new_from = self._fetch_back(start, end, fetch, chunk_days, budget)
+            with self._lock:
+                meta = self._read_meta()
+                meta["covered_from"] = min(new_from, meta.get("covered_from", new_from))
+                self._write_meta(meta)
+            return new_from
+        finally:
+            self._backfill_lock.release()
+
+    def sync(self, start, fetch, chunk_days):
+        """確保 [start, 最新交易日] 都在本地；只向上游要缺少的區段。"""
+        with self._lock:
+            meta = self._read_meta()
+            today = date.today().strftime("%Y-%m-%d")
+            covered_from = meta.get("covered_from")
+            if covered_from is None or start < covered_from:
+                # 首次建庫或要求更早的歷史：補抓 [start, covered_from)
+                end = today if covered_from is None else \
+                    (datetime.strptime(covered_from, "%Y-%m-%d").date() - timedelta(days=1)).strftime("%Y-%m-%d")
+                self._fetch_range(start, end, fetch, chunk_days)
+                meta["covered_from"] = start
+                if covered_from is None: meta["checked_at"] = _epoch_now()
+            days = self.dates()
+            last = days[-1] if days else start
+            stale = _epoch_now() - meta.get("checked_at", 0) > STORE_RECHECK_SEC
+            if last < _expected_latest_day() and stale:
+                # 每日增量：從最後一個分區 (可能還會補夜盤) 抓到今天
+                self._fetch_range(last, today, fetch, chunk_days)
+                meta["checked_at"] = _epoch_now()
+            self._write_meta(meta)
+
+    def read(self, start, end=None):
+        if not self.dates():
+            return pd.DataFrame()
+        part = pa_ds.partitioning(pa.schema([("month", pa.string())]), flavor="hive")
+        dataset = pa_ds.dataset(self.root, format="parquet", partitioning=part)
+        flt = (pa_ds.field("month") >= start[:7]) & (pa_ds.field("date") >= start)   # 先以月份剪枝
+        if end: flt = flt & (pa_ds.field("month") <= end[:7]) & (pa_ds.field("date") <= end)
+        df = dataset.to_table(filter=flt).to_pandas()
+        if df.empty:
+            return df
+        df = df.drop(columns=["month"])
+        df = df[["date"] + [c for c in df.columns if c != "date"]]
+        return df.sort_values("date", kind="stable").reset_index(drop=True)
+
+@st.cache_resource(show_spinner=False)
+def get_daily_store(name):
+    return DailyStore(name)
+
+def read_store(name, token, days, latest_only=False):
+    """從本地庫讀最近 days 天的資料，必要時先向 FinMind 補抓差額。"""
+    fetch, chunk_days = STORE_DATASETS[name]
+    dl = get_finmind(token)
+    start = (date.today() - timedelta(days=days)).strftime("%Y-%m-%d")
+    store = get_daily_store(name)
+    store.sync(start, lambda a, b: fetch(dl, a, b), chunk_days)
+    if latest_only:
+        days_in = [d for d in store.dates() if d >= start]
+        return store.read(days_in[-1]) if days_in else pd.DataFrame()
+    return store.read(start)
+
+# ---- 證券主檔：本地快取、每日更新，代號/名稱 O(1) 查詢 + 前綴/模糊建議 ----
+SECURITY_MASTER_FILE = os.path.join(STORE_DIR, "security_master.parquet")
+ETF_KEYWORDS = ["ETF", "指數股票型", "基金", "債券", "期信", "etf"]
+
+# 離線保底：主檔下載失敗且本地也沒有檔案時使用
+LOCAL_INDUSTRY_MAP = {
+    "2330": ("台積電",    "半導體業"), "2454": ("聯發科",    "半導體業"),
+    "2317": ("鴻海",      "電子業"),   "2303": ("聯電",      "半導體業"),
+    "2603": ("長榮",      "航運業"),   "2609": ("陽明",      "航運業"),
+    "2610": ("華航",      "航空業"),   "2618": ("長榮航",    "航空業"),
+    "2608": ("嘉里大榮",  "陸運業"),   "6214": ("精誠",      "資訊服務業"),
+    "2881": ("富邦金",    "金融保險業"),"2344": ("華邦電",    "記憶體"),
+    "1264": ("德麥",      "食品工業"), "0050": ("元大台灣50", "ETF"),
+    "0056": ("元大高股息","ETF"),
+}
+
+class SecurityMaster:
+    """taiwan_stock_info 的記憶體索引；查詢與建議都不碰網路。"""
+
+    def __init__(self, df):
+        df = df.drop_duplicates("stock_id", keep="first")
+        ids = df["stock_id"].astype(str).tolist()
+        names = df["stock_name"].astype(str).tolist()
+        inds = df["industry_category"].astype(str).tolist()
+        self.by_id = {i: (n, c) for i, n, c in zip(ids, names, inds)}
+        self.by_name = {}
+        for i, n in zip(ids, names):
+            self.by_name.setdefault(n, i)
+        self._ids = sorted(self.by_id)
+        self._names = sorted(self.by_name)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def resolve(self, query):
+        """代號或完整名稱 -> 代號；查不到原樣回傳。"""
+        q = str(query).strip()
+        return q if q in self.by_id else self.by_name.get(q, q)
+
+    def lookup(self, code):
+        """-> (名稱, 產業) 或 None。"""
+        return self.by_id.get(self.resolve(code))
+
+    def is_etf(self, code):
+        code = self.resolve(code)
+        name, industry = self.by_id.get(code, ("", ""))
+        return code.startswith("0") or any(k.lower() in (industry + name).lower() for k in ETF_KEYWORDS)
+
+    @staticmethod
+    def _prefix(keys, q, limit):
+        i = bisect.bisect_left(keys, q)
+        out = []
+        while i < len(keys) and keys[i].startswith(q) and len(out) < limit:
+            out.append(keys[i]); i += 1
+        return out
+
+    def suggest(self, query, limit=8):
+        """type-ahead：代號前綴 → 名稱前綴 → 名稱包含 (模糊)，回傳 [(代號, 名稱)]。"""
+        q = str(query).strip()
+        if not q: return []
+        hits = self._prefix(self._ids, q, limit)
+        hits += [self.by_name[n] for n in self._prefix(self._names, q, limit)]
+        if len(hits) < limit:
+            hits += [self.by_name[n] for n in self._names if q.lower() in n.lower()]
+        seen, out = set(), []
+        for sid in hits:
+            if sid not in seen:
+                seen.add(sid); out.append((sid, self.by_id[sid][0]))
+            if len(out) >= limit: break
+        return out
+
+def _load_security_table(token):
+    """本地主檔今天已更新就直接讀；否則重抓一次，失敗則沿用舊檔或離線保底。"""
+    cols = ["stock_id", "stock_name", "industry_category"]
+    fresh = os.path.exists(SECURITY_MASTER_FILE) and \
+        date.fromtimestamp(os.path.getmtime(SECURITY_MASTER_FILE)) == date.today()
+    if not fresh:
+        try:
+            df = get_finmind(token).taiwan_stock_info()[cols].astype(str)
+            os.makedirs(STORE_DIR, exist_ok=True)
+            tmp = SECURITY_MASTER_FILE + ".tmp"
+            pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp)
+            os.replace(tmp, SECURITY_MASTER_FILE)
+            return df
+        except Exception:
+            pass
+    if os.path.exists(SECURITY_MASTER_FILE):
+        return pq.read_table(SECURITY_MASTER_FILE).to_pandas()
+    return pd.DataFrame([(k, n, c) for k, (n, c) in LOCAL_INDUSTRY_MAP.items()], columns=cols)
+
+@st.cache_resource(ttl=3600, show_spinner=False)
+def get_security_master(token):
+    df = _load_security_table(token)
+    # 保底字典補在後面：主檔缺漏時仍查得到
+    seed = pd.DataFrame([(k, n, c) for k, (n, c) in LOCAL_INDUSTRY_MAP.items()], columns=df.columns[:3])
+    return SecurityMaster(pd.concat([df, seed], ignore_index=True))
+
+# ---- 研究任務快取：(代碼, 觀察期, 權重, 交易日) -> 報告，TTL + LRU，跨 session 共用 ----
+RESEARCH_CACHE_TTL = 6 * 3600
+RESEARCH_CACHE_MAX = 64
+
+class ResearchJobCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize, self.ttl = maxsize, ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None: return None
+            if monotonic() - item[0] > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+@st.cache_resource(show_spinner=False)
+def get_research_cache():
+    return ResearchJobCache(RESEARCH_CACHE_MAX, RESEARCH_CACHE_TTL)
+
+# ---- TAIEX 單一來源：一份去重後的日 K，一次算完所有衍生欄位 ----
+TAIEX_HISTORY_DAYS = 3800   # 約十年：walk-forward 樣本外驗證 (回測最長 750 交易日 + 季線暖機也在內)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def get_taiex_frame(token):
+    """全站共用的 TAIEX 日 K (回傳副本，呼叫端改動不影響快取)。
+
+    欄位：close/max/min + MA20、MA60、High20 (20日高)、Low60 (60日低)、
+    Daily_Ret、Chg_Pct、Signal (close > MA20 > MA60，回測用)。
+    """
+    df = read_store("TAIEX", token, TAIEX_HISTORY_DAYS)
+    if df.empty: return pd.DataFrame()
+    df["date"] = pd.to_datetime(df["date"])
+    df = df[df["Trading_Volume"] > 0]
+    df = df.drop_duplicates("date", keep="last").sort_values("date").reset_index(drop=True)
+    close = df["close"].astype(float)
+    df["close"] = close
+    df["MA20"] = close.rolling(20).mean()
+    df["MA60"] = close.rolling(60).mean()
+    df["High20"] = df["max"].rolling(20, min_periods=1).max()
+    df["Low60"] = df["min"].rolling(60, min_periods=1).min()
+    df["Daily_Ret"] = close.pct_change().fillna(0)
+    df["Chg_Pct"] = df["Daily_Ret"] * 100
+    df["Signal"] = (close > df["MA20"]) & (df["MA20"] > df["MA60"])
+    return df
+
+@st.cache_data(ttl=60, show_spinner=False)
+def get_taiex_levels(token):
+    """最新一日的關鍵點位 (純量)，供大盤快報、跑馬燈、支撐壓力共用。"""
+    df = get_taiex_frame(token)
+    if df.empty: return {}
+    last = df.iloc[-1]
+    S = float(last["close"])
+    return {
+        "date": last["date"], "close": S,
+        "prev_close": float(df["close"].iloc[-2]) if len(df) > 1 else S,
+        "chg_pct": float(last["Chg_Pct"]),
+        "ma20": float(last["MA20"]) if len(df) > 20 else S * 0.98,
+        "ma60": float(last["MA60"]) if len(df) > 60 else S * 0.95,
+        "pressure": float(last["High20"]), "support": float(last["Low60"]),
+    }
+
 @st.cache_data(ttl=60)
 def get_data(token):
-    dl = DataLoader()
-    if token: dl.login_by_token(api_token=token)
     try:
-        index_df = dl.taiwan_stock_daily("TAIEX", start_date=(date.today()-timedelta(days=100)).strftime("%Y-%m-%d"))
-        S = float(index_df["close"].iloc[-1]) if not index_df.empty else 23000.0
-        ma20 = index_df['close'].rolling(20).mean().iloc[-1] if len(index_df) > 20 else S * 0.98
-        ma60 = index_df['close'].rolling(60).mean().iloc[-1] if len(index_df) > 60 else S * 0.95
+        lv = get_taiex_levels(token)
+        S = lv["close"] if lv else 23000.0
+        ma20 = lv.get("ma20", S * 0.98)
+        ma60 = lv.get("ma60", S * 0.95)
     except: 
         S, ma20, ma60 = 23000.0, 22800.0, 22500.0
 
-    opt_start = (date.today() - timedelta(days=30)).strftime("%Y-%m-%d")
-    df = dl.taiwan_option_daily("TXO", start_date=opt_start)
+    df = read_store("TXO", token, 30, latest_only=True)
+    if not df.empty and "trading_session" in df.columns:   # 只用一般交易時段，盤後 (after_market) 另列一筆會重複計算
+        df = df[df["trading_session"].astype(str) == "position"]
     if df.empty: return S, pd.DataFrame(), pd.to_datetime(date.today()), ma20, ma60
     
     df["date"] = pd.to_datetime(df["date"])
@@ -136,8 +693,7 @@ def get_data(token):
 
 @st.cache_data(ttl=1800)
 def get_real_news(token):
-    dl = DataLoader()
-    if token: dl.login_by_token(api_token=token)
+    dl = get_finmind(token)
     start_date = (date.today() - timedelta(days=3)).strftime("%Y-%m-%d")
     try:
         news = dl.taiwan_stock_news(stock_id="TAIEX", start_date=start_date)
@@ -151,8 +707,7 @@ def get_real_news(token):
 
 @st.cache_data(ttl=1800)
 def get_institutional_data(token):
-    dl = DataLoader()
-    if token: dl.login_by_token(api_token=token)
+    dl = get_finmind(token)
     start_date = (date.today() - timedelta(days=10)).strftime("%Y-%m-%d")
     try:
         df = dl.taiwan_stock_institutional_investors_total(start_date=start_date)
@@ -165,55 +720,887 @@ def get_institutional_data(token):
     except:
         return pd.DataFrame()
 
-@st.cache_data(ttl=3600)
 def get_support_pressure(token):
-    dl = DataLoader()
-    if token: dl.login_by_token(api_token=token)
-    start_date = (date.today() - timedelta(days=90)).strftime("%Y-%m-%d")
     try:
-        df = dl.taiwan_stock_daily("TAIEX", start_date=start_date)
-        if df.empty: return 0, 0
-        pressure = df['max'].tail(20).max()
-        support = df['min'].tail(60).min()
-        return pressure, support
+        lv = get_taiex_levels(token)
+        if not lv: return 0, 0
+        return lv["pressure"], lv["support"]
     except:
         return 0, 0
 
+# ---- 均線策略參數掃描：所有視窗的均線來自同一條 cumsum，訊號與報酬皆為多維陣列一次算完 ----
+def ma_sweep_returns(close, fast_windows, slow_windows, leverages, period_days, skip_first=True):
+    """close > MA_fast > MA_slow 持有 (隔日生效)，槓桿倍數放大日報酬；只取最後 period_days 天。
+    回傳策略日報酬 (len(fast), len(slow), len(leverages), t)；skip_first 時區間第一天不計報酬 (與 Tab3 一致)。"""
+    close = np.asarray(close, dtype=float)
+    fast, slow = np.asarray(fast_windows, dtype=int), np.asarray(slow_windows, dtype=int)
+    lev = np.asarray(leverages, dtype=float)
+    n = close.size
+    cs = np.concatenate([[0.0], np.cumsum(close)])
+    windows = np.union1d(fast, slow)
+    ma = np.full((windows.size, n), np.nan)
+    for i, w in enumerate(windows):
+        if w <= n: ma[i, w - 1:] = (cs[w:] - cs[:-w]) / w
+    F = ma[np.searchsorted(windows, fast)][:, None, :]      # (nf, 1, n)
+    S = ma[np.searchsorted(windows, slow)][None, :, :]      # (1, ns, n)
+    signal = (close > F) & (F > S)                           # NaN 比較為 False，暖機期自然空倉
+
+    daily = np.zeros(n)
+    daily[1:] = close[1:] / close[:-1] - 1
+    start = max(n - int(period_days), 1)
+    window = daily[start:].copy()
+    if skip_first: window[0] = 0.0
+    pos = signal[:, :, start - 1:n - 1]                      # 前一日訊號決定今日部位
+    return pos[:, :, None, :] * window * lev[None, None, :, None]   # (nf, ns, nl, t)
+
+def ma_sweep(close, fast_windows, slow_windows, leverages, period_days):
+    """參數全組合績效。回傳 {"ret", "sharpe", "mdd"}，形狀皆為 (len(fast), len(slow), len(leverages))，
+    fast >= slow 的組合為 NaN。Sharpe 用樣本標準差 (ddof=1)，與 get_ma_backtest (pandas) 一致；Sharpe 與槓桿無關。"""
+    strat = ma_sweep_returns(close, fast_windows, slow_windows, leverages, period_days)
+    equity = np.cumprod(1 + strat, axis=-1)
+    peak = np.maximum.accumulate(equity, axis=-1)
+    std = strat.std(axis=-1, ddof=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sharpe = np.where(std > 0, strat.mean(axis=-1) / std * np.sqrt(252), 0.0)
+    out = {"ret": (equity[..., -1] - 1) * 100, "sharpe": sharpe, "mdd": ((peak - equity) / peak).max(axis=-1) * 100}
+    invalid = (np.asarray(fast_windows)[:, None] >= np.asarray(slow_windows)[None, :])[:, :, None]
+    return {k: np.where(invalid, np.nan, v) for k, v in out.items()}
+
+# ---- Walk-forward 樣本外驗證：滾動 訓練 -> 測試，每段在訓練區挑最佳參數、下一段測試 ----
+WF_FAST = tuple(range(5, 65, 5))
+WF_SLOW = tuple(range(20, 250, 10))
+WF_WARMUP = 250            # 最長均線的暖機天數
+
+def _wf_fold(task):
+    """單一 fold：close[:train_end] 的最後 train_days 天挑 Sharpe 最高的 (快線, 慢線)，再以固定槓桿套用到接下來 test_days 天。
+    Sharpe 與槓桿無關，只用 1x 掃描挑均線；槓桿由呼叫端指定。"""
+    close, train_end, train_days, test_days, leverage = task
+    res = ma_sweep(close[:train_end], WF_FAST, WF_SLOW, [1], train_days)
+    i, j, _ = np.unravel_index(np.nanargmax(res["sharpe"]), res["sharpe"].shape)
+    oos = ma_sweep_returns(close[:train_end + test_days], [WF_FAST[i]], [WF_SLOW[j]], [leverage],
+                           test_days, skip_first=False)[0, 0, 0]
+    return {"fast": WF_FAST[i], "slow": WF_SLOW[j], "is_sharpe": float(res["sharpe"][i, j, 0]), "oos": oos}
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def get_walk_forward(data_date, train_days, test_days, leverage, _dates, _close):
+    """回傳 (folds, oos)：folds 為每段選到的均線與訓練/測試績效；oos 為串接後的樣本外日報酬 (含大盤對照)。
+    Sharpe 一律用樣本標準差 (ddof=1，與 pandas / Tab3 KPI 一致)。每段只要幾毫秒，依序執行 (開進程反而更慢)。"""
+    close = np.asarray(_close, dtype=float)
+    dates = pd.to_datetime(pd.Series(_dates)).to_numpy()
+    ends = list(range(WF_WARMUP + train_days, close.size - test_days + 1, test_days))
+    results = [_wf_fold((close, e, train_days, test_days, leverage)) for e in ends]
+    folds, parts = [], []
+    for e, r in zip(ends, results):
+        oos = r.pop("oos")
+        sd = oos.std(ddof=1)
+        folds.append({"測試起": dates[e], "測試迄": dates[e + test_days - 1], "快線": r["fast"], "慢線": r["slow"],
+                      "訓練 Sharpe": r["is_sharpe"],
+                      "測試 Sharpe": oos.mean() / sd * np.sqrt(252) if sd > 0 else 0.0,
+                      "測試報酬 %": (np.prod(1 + oos) - 1) * 100})
+        parts.append(pd.DataFrame({"date": dates[e:e + test_days], "Strategy_Ret": oos,
+                                   "Daily_Ret": close[e:e + test_days] / close[e - 1:e + test_days - 1] - 1}))
+    if not parts: return pd.DataFrame(), pd.DataFrame()
+    return pd.DataFrame(folds), pd.concat(parts, ignore_index=True)
+
+# ---- 蒙地卡羅：分塊 float32 模擬，每塊獨立種子，直方圖串流累積分位數 (記憶體與路徑數無關) ----
+MC_CHUNK = 20_000
+MC_BINS = 2048
+MC_SPREAD = 8.0            # 每個預測日的直方圖範圍 = 期望值 ± 8 倍標準差 (對數報酬)
+
+def monte_carlo(rets, days, n_paths, model="normal", block=20, seed=42, quantiles=(5, 25, 50, 75, 95),
+                use_processes=False, chunk=MC_CHUNK):
+    """以歷史日報酬 rets 模擬 n_paths 條 days 天的淨值路徑 (起點 = 1)。
+    model="normal" 用 rets 的平均/標準差抽 i.i.d. 常態；"bootstrap" 以長度 block 的區塊重抽實際報酬。
+    回傳 index = 第 1..days 天、欄位 = 分位數 (淨值倍數) 的 DataFrame，大小與路徑數無關，可直接畫扇形圖。"""
+    rets = np.asarray(rets, dtype=np.float32)
+    rets = rets[np.isfinite(rets)]
+    if rets.size == 0: rets = np.zeros(1, dtype=np.float32)
+    mu, sigma = float(rets.mean()), float(rets.std())
+    logs = np.log1p(np.maximum(rets.astype(float), -0.99))
+    m, s = logs.mean(), max(logs.std(), 1e-4)
+    t = np.arange(1, days + 1)
+    lo = (m * t - MC_SPREAD * s * np.sqrt(t))[None, :].astype(np.float32)
+    width = (2 * MC_SPREAD * s * np.sqrt(t) / MC_BINS)[None, :].astype(np.float32)
+
+    sizes = [min(chunk, n_paths - i) for i in range(0, n_paths, chunk)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(model, rets, mu, sigma, block, n, days, sq, lo, width, MC_BINS) for n, sq in zip(sizes, seeds)]
+    counts = np.zeros((days, MC_BINS), dtype=np.int64)
+    for c in map_parallel(mc_chunk, tasks, use_processes):
+        counts += c
+
+    cum = np.cumsum(counts, axis=1)
+    out = {}
+    for q in quantiles:
+        target = q / 100 * n_paths
+        k = np.argmax(cum >= target, axis=1)
+        prev = np.where(k > 0, cum[np.arange(days), k - 1], 0)
+        frac = (target - prev) / np.maximum(counts[np.arange(days), k], 1)
+        out[q] = np.exp(lo[0] + (k + frac) * width[0])
+    return pd.DataFrame(out, index=t)
+
+# ---- 均線回測快取：(資料日期, 回測天數, 槓桿) -> 單位本金資金曲線 + KPI，全站共用；本金只在顯示時縮放 ----
+@st.cache_data(ttl=86400, show_spinner=False)
+def get_ma_backtest(data_date, period_days, leverage, _frame):
+    """close > MA20 > MA60 隔日持有。回傳 (df, kpi)：df 的 Equity_* 以本金 1 計；_frame 為 get_taiex_frame 結果。"""
+    df = _frame.dropna(subset=['MA20', 'MA60']).tail(period_days).reset_index(drop=True)
+    df = df[['date', 'close', 'MA20', 'Signal', 'Daily_Ret']].copy()
+    df['Daily_Ret'] = df['Daily_Ret'].where(df.index > 0, 0.0)
+    df['Strategy_Ret'] = df['Signal'].shift(1).fillna(False) * df['Daily_Ret'] * leverage
+    df['Equity_Strategy'] = (1 + df['Strategy_Ret']).cumprod()
+    df['Equity_Benchmark'] = (1 + df['Daily_Ret']).cumprod()
+    df['Equity_Peak'] = df['Equity_Strategy'].cummax()
+
+    signal_days = df['Signal'].shift(1) == True
+    std = df['Strategy_Ret'].std()
+    kpi = {
+        "total_ret": (df['Equity_Strategy'].iloc[-1] - 1) * 100,
+        "bench_ret": (df['Equity_Benchmark'].iloc[-1] - 1) * 100,
+        "win_rate": (df[signal_days & (df['Strategy_Ret'] > 0)].shape[0] / signal_days.sum() * 100) if signal_days.sum() > 0 else 0,
+        "mdd": ((df['Equity_Peak'] - df['Equity_Strategy']) / df['Equity_Peak']).max() * 100,
+        "sharpe": df['Strategy_Ret'].mean() / std * np.sqrt(252) if std > 0 else 0,
+    }
+    return df, kpi
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def get_mc_bands(data_date, period_days, leverage, n_paths, model, _rets, _use_processes=False):
+    """蒙地卡羅分位數帶 (單位本金)；與回測共用 (資料日期, 回測天數, 槓桿) 鍵，再加路徑數與模型。"""
+    return monte_carlo(_rets, 252, n_paths, model, quantiles=(5, 10, 25, 50, 75, 90, 95), use_processes=_use_processes)
+
+# ---- 交易日曆 + 合約到期索引：月選/週選 (W 週三、F 週五) 都換成真實結算日與剩餘交易日 ----
+TW_HOLIDAYS = holidays.TW(years=range(2015, date.today().year + 3))
+TW_BUSDAY_CAL = np.busdaycalendar(weekmask="1111100", holidays=sorted(d for d in TW_HOLIDAYS if d.weekday() < 5))
+TRADING_DAYS_PER_YEAR = 252
+
+def contract_expiry(code):
+    """YYYYMM -> 第三個週三；YYYYMMWn -> 第 n 個週三；YYYYMMFn -> 第 n 個週五；遇假日順延到下一個交易日。
+    無法解析 (價差組合等) 回傳 None。"""
+    code = str(code).strip()
+    try:
+        y, m = int(code[:4]), int(code[4:6])
+        if len(code) == 6: weekmask, n = "Wed", 3
+        elif len(code) == 8 and code[6] in "WF": weekmask, n = ("Wed" if code[6] == "W" else "Fri"), int(code[7])
+        else: return None
+        first = np.datetime64(f"{y:04d}-{m:02d}-01")
+        nth = np.busday_offset(first, n - 1, roll="forward", weekmask=weekmask)
+        if nth.astype("datetime64[M]") != first.astype("datetime64[M]"): return None
+        return np.busday_offset(nth, 0, roll="forward", busdaycal=TW_BUSDAY_CAL)
+    except: return None
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def get_contract_index(date_key, codes):
+    """當日出現的 contract_date (tuple) 各解析一次 -> expiry, days (日曆天), tdays (交易日), T (= tdays / 252)。
+    已到期或無法解析的代碼不列入；依到期日排序。"""
+    ref = np.datetime64(date_key, "D")
+    rows = []
+    for c in sorted(set(codes)):
+        exp = contract_expiry(c)
+        if exp is None or exp < ref: continue
+        tdays = max(int(np.busday_count(ref, exp, busdaycal=TW_BUSDAY_CAL)), 1)
+        rows.append((c, pd.Timestamp(exp), max(int((exp - ref) / np.timedelta64(1, "D")), 1), tdays))
+    idx = pd.DataFrame(rows, columns=["contract_date", "expiry", "days", "tdays"]).set_index("contract_date")
+    idx["T"] = idx["tdays"] / TRADING_DAYS_PER_YEAR
+    return idx.sort_values("expiry")
+
+def _clean_chain(chain):
+    """TXO 日資料統一型別 (含 open_interest、settle)。"""
+    df = chain[["contract_date", "call_put", "strike_price", "close", "volume"]].copy()
+    df["open_interest"] = chain["open_interest"] if "open_interest" in chain.columns else 0
+    df["settle"] = chain["settlement_price"] if "settlement_price" in chain.columns else 0
+    df["contract_date"] = df["contract_date"].astype(str).str.strip()
+    df["call_put"] = df["call_put"].astype(str).str.upper().str.strip()
+    for col in ["strike_price", "close", "volume", "open_interest", "settle"]:
+        df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0)
+    df["settle"] = df["settle"].where(df["settle"] > 0, df["close"])   # 無結算價時退回收盤價
+    return df
+
+def _prepare_chain(date_key, chain):
+    """單日 TXO：統一型別後以合約索引對齊帶入 expiry/days/tdays/T (不逐列解析字串)。"""
+    df = _clean_chain(chain)
+    cidx = get_contract_index(date_key, tuple(pd.unique(df["contract_date"])))
+    return df.join(cidx, on="contract_date", how="inner")
+
+def bs_greeks(S, K, T, r, sigma, is_call):
+    """整條鏈一次算 price/delta/gamma/vega/theta (全部可廣播)。T 以交易日年化，vega 為每 1 個波動率百分點，theta 為每交易日。
+    T<=0 或參數無效時 price=0、delta=0.5，其餘 greeks 為 0。"""
+    S, K, T, sigma = (np.asarray(x, dtype=float) for x in (S, K, T, sigma))
+    is_call = np.asarray(is_call, dtype=bool)
+    ok = (T > 0) & (sigma > 0) & (S > 0) & (K > 0)
+    T_, sig_, K_ = np.where(ok, T, 1.0), np.where(ok, sigma, 1.0), np.where(ok, K, 1.0)
+    sqrt_t = np.sqrt(T_)
+    vol_t = sig_ * sqrt_t
+    d1 = (np.log(S / K_) + (r + 0.5 * sig_**2) * T_) / vol_t
+    d2 = d1 - vol_t
+    disc_k = K_ * np.exp(-r * T_)
+    nd1, nd2, pdf1 = norm.cdf(d1), norm.cdf(d2), norm.pdf(d1)
+    price = np.where(is_call, S * nd1 - disc_k * nd2, disc_k * (1.0 - nd2) - S * (1.0 - nd1))
+    delta = np.where(is_call, nd1, nd1 - 1.0)
+    decay = -S * pdf1 * sig_ / (2 * sqrt_t)
+    theta = np.where(is_call, decay - r * disc_k * nd2, decay + r * disc_k * (1.0 - nd2)) / TRADING_DAYS_PER_YEAR
+    return {
+        "price": np.where(ok, price, 0.0),
+        "delta": np.where(ok, delta, 0.5),
+        "gamma": np.where(ok, pdf1 / (S * vol_t), 0.0),
+        "vega": np.where(ok, S * pdf1 * sqrt_t / 100.0, 0.0),
+        "theta": np.where(ok, theta, 0.0),
+    }
+
+def bs_chain(S, K, T, r, sigma, is_call, premium=None):
+    """整條鏈一次定價：S/K/T/sigma/is_call 可為陣列 (自動廣播)，回傳 (price, delta, leverage)。
+    leverage 以 premium (市價) 為分母，未給時用理論價；T<=0 或參數無效時 price=0、delta=0.5、leverage=0。"""
+    g = bs_greeks(S, K, T, r, sigma, is_call)
+    price, delta = g["price"], g["delta"]
+    P = price if premium is None else np.asarray(premium, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lev = np.where(P > 0, np.abs(delta) * np.asarray(S, dtype=float) / P, 0.0)
+    return price, delta, lev
+
 def bs_price_delta(S, K, T, r, sigma, cp):
     if T <= 0: return 0.0, 0.5
     try:
-        d1 = (np.log(S/K) + (r + 0.5*sigma**2)*T) / (sigma * np.sqrt(T))
-        d2 = d1 - sigma * np.sqrt(T)
-        if cp == "CALL": return S*norm.cdf(d1)-K*np.exp(-r*T)*norm.cdf(d2), norm.cdf(d1)
-        return K*np.exp(-r*T)*norm.cdf(-d2)-S*norm.cdf(-d1), -norm.cdf(-d1)
+        price, delta, _ = bs_chain(S, K, T, r, sigma, cp == "CALL")
+        return float(price), float(delta)
     except: return 0.0, 0.5
 
-def calculate_win_rate(delta, days):
-    return min(max((abs(delta)*0.7 + 0.8*0.3)*100, 1), 99)
+# ---- 隱含波動率：整條鏈一次反推 (Newton + 二分保護) ----
+IV_LO, IV_HI = 0.01, 3.0
+IV_DEFAULT = 0.2
+
+def implied_vol_chain(price, S, K, T, r, is_call, tol=1e-4, max_iter=60):
+    """對所有合約同時反推 IV。每步先試 Newton，跳出 [lo, hi] 區間或 vega 太小就改走二分；
+    市價不在 [IV_LO, IV_HI] 對應價格範圍內 (低於內含價值等) 的合約回傳 NaN。"""
+    price, K, T = (np.asarray(x, dtype=float) for x in (price, K, T))
+    S = np.broadcast_to(np.asarray(S, dtype=float), price.shape)
+    is_call = np.broadcast_to(np.asarray(is_call, dtype=bool), price.shape)
+    lo, hi = np.full(price.shape, IV_LO), np.full(price.shape, IV_HI)
+    p_lo, _, _ = bs_chain(S, K, T, r, lo, is_call)
+    p_hi, _, _ = bs_chain(S, K, T, r, hi, is_call)
+    valid = (T > 0) & (K > 0) & (price > 0) & (price >= p_lo) & (price <= p_hi)
+    sigma = np.full(price.shape, IV_DEFAULT)
+    active = valid.copy()
+    for _ in range(max_iter):
+        if not active.any(): break
+        g = bs_greeks(S, K, T, r, sigma, is_call)
+        diff = g["price"] - price
+        active &= np.abs(diff) > tol
+        # 價格對 sigma 單調遞增：diff>0 代表 sigma 太大
+        hi = np.where(active & (diff > 0), sigma, hi)
+        lo = np.where(active & (diff <= 0), sigma, lo)
+        vega = g["vega"] * 100.0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            newton = sigma - diff / vega
+        bad = ~np.isfinite(newton) | (newton <= lo) | (newton >= hi) | (vega < 1e-8)
+        sigma = np.where(active, np.where(bad, 0.5 * (lo + hi), newton), sigma)
+    return np.where(valid, sigma, np.nan)
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def get_chain_iv(date_key, S, _chain, r=0.02):
+    """每個交易日 (date_key) 算一次：有成交合約的 IV 表 (contract_date, call_put, strike_price, days, iv)。
+    _chain 以底線開頭不參與快取 key，呼叫端傳當日 df_latest。"""
+    if _chain is None or _chain.empty: return pd.DataFrame(columns=["contract_date", "call_put", "strike_price", "days", "iv"])
+    df = _prepare_chain(date_key, _chain)
+    df = df[(df["volume"] > 0) & (df["close"] > 0)]
+    df["iv"] = implied_vol_chain(df["close"].to_numpy(), S, df["strike_price"].to_numpy(),
+                                 df["T"].to_numpy(), r, (df["call_put"] == "CALL").to_numpy())
+    return df[["contract_date", "call_put", "strike_price", "days", "iv"]].dropna(subset=["iv"]).reset_index(drop=True)
+
+def smile_sigma(iv_df, contract, cp, strikes, default=IV_DEFAULT):
+    """同月份同方向的 IV 依履約價線性內插 (兩端取端點值)；完全沒有成交時用 default。"""
+    strikes = np.asarray(strikes, dtype=float)
+    if iv_df is None or iv_df.empty: return np.full(strikes.shape, default)
+    sm = iv_df[(iv_df["contract_date"] == str(contract)) & (iv_df["call_put"] == cp)]
+    if sm.empty: return np.full(strikes.shape, default)
+    sm = sm.groupby("strike_price")["iv"].mean()
+    return np.interp(strikes, sm.index.to_numpy(float), sm.to_numpy(float))
+
+# ---- OI 牆 + 最大痛點：各到期日依履約價彙總 call/put OI，前綴和 O(n) 求 max pain ----
+def max_pain(strikes, call_oi, put_oi):
+    """strikes 需遞增。結算在 K_j 時賣方總賠付 = K_j·ΣC(<j) - Σ(C·K)(<j) + Σ(P·K)(>j) - K_j·ΣP(>j)，
+    四項都是前綴/後綴和，一次 cumsum 即得全部履約價的賠付。回傳 (痛點履約價, 賠付陣列)。"""
+    K, C, P = (np.asarray(x, dtype=float) for x in (strikes, call_oi, put_oi))
+    if K.size == 0: return np.nan, K
+    c_below, ck_below = np.cumsum(C) - C, np.cumsum(C * K) - C * K
+    p_above, pk_above = P.sum() - np.cumsum(P), (P * K).sum() - np.cumsum(P * K)
+    pay = K * c_below - ck_below + pk_above - K * p_above
+    return K[np.argmin(pay)], pay
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def get_oi_walls(date_key, _chain):
+    """每個交易日算一次。回傳 (walls, summary)：
+    walls   index=contract_date，欄位 strike_price/call_oi/put_oi/pain (依履約價遞增)；
+    summary index=contract_date (依到期日排序)，欄位 expiry/max_pain/call_wall/put_wall/pcr。"""
+    wall_cols = ["strike_price", "call_oi", "put_oi", "pain"]
+    sum_cols = ["expiry", "max_pain", "call_wall", "put_wall", "pcr"]
+    empty = (pd.DataFrame(columns=["contract_date"] + wall_cols).set_index("contract_date"),
+             pd.DataFrame(columns=["contract_date"] + sum_cols).set_index("contract_date"))
+    if _chain is None or _chain.empty: return empty
+    df = _prepare_chain(date_key, _chain)
+    df = df[(df["strike_price"] > 0) & df["call_put"].isin(["CALL", "PUT"])]
+    if df.empty or df["open_interest"].sum() <= 0: return empty
+
+    oi = df.pivot_table(index=["contract_date", "strike_price"], columns="call_put", values="open_interest",
+                        aggfunc="sum", fill_value=0).reindex(columns=["CALL", "PUT"], fill_value=0)
+    expiry = df.groupby("contract_date")["expiry"].first()
+    walls, summary = [], []
+    for con, g in oi.groupby(level="contract_date"):
+        K = g.index.get_level_values("strike_price").to_numpy(float)
+        C, P = g["CALL"].to_numpy(float), g["PUT"].to_numpy(float)
+        mp, pay = max_pain(K, C, P)
+        walls.append(pd.DataFrame({"contract_date": con, "strike_price": K, "call_oi": C, "put_oi": P, "pain": pay}))
+        summary.append((con, expiry[con], mp, K[np.argmax(C)], K[np.argmax(P)], P.sum() / C.sum() if C.sum() else np.nan))
+    return (pd.concat(walls).set_index("contract_date"),
+            pd.DataFrame(summary, columns=["contract_date"] + sum_cols).set_index("contract_date").sort_values("expiry"))
+
+# ---- 造市商 Gamma 曝險 (GEX)：全部合約 × 假設現價網格一次廣播計算 ----
+TXO_MULTIPLIER = 50
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def get_gex_profile(date_key, S, _chain, r=0.02, width_pct=0.1, n_grid=201):
+    """每個交易日算一次。造市商視為 call 淨多、put 淨空 (call 正、put 負)，
+    GEX = gamma × OI × 50 × S² × 1% (指數漲跌 1% 時避險需調整的金額，元)。回傳 (by_strike, profile, flip)：
+    by_strike 現價下各履約價淨 GEX；profile 為 spot 網格上的總 GEX；flip 為最接近現價的零 Gamma 點 (無則 NaN)。"""
+    empty = (pd.DataFrame(columns=["strike_price", "gex"]), pd.DataFrame(columns=["spot", "gex"]), np.nan)
+    g = get_greeks_table(date_key, S, _chain, r).reset_index()
+    g = g[g["open_interest"] > 0]
+    if g.empty: return empty
+    sign = np.where(g["call_put"] == "CALL", 1.0, -1.0)
+    weight = sign * g["open_interest"].to_numpy(float) * TXO_MULTIPLIER * 0.01
+
+    by_strike = (pd.DataFrame({"strike_price": g["strike_price"], "gex": weight * g["gamma"].to_numpy() * S**2})
+                 .groupby("strike_price", as_index=False)["gex"].sum())
+
+    # (n_grid, 1) × (1, n_contracts) 廣播；記憶體 ~ n_grid × n_contracts × 8 bytes
+    spots = np.linspace(S * (1 - width_pct), S * (1 + width_pct), n_grid)
+    gamma = bs_greeks(spots[:, None], g["strike_price"].to_numpy()[None, :], g["T"].to_numpy()[None, :], r,
+                      g["iv"].to_numpy()[None, :], (g["call_put"] == "CALL").to_numpy()[None, :])["gamma"]
+    total = (gamma * weight[None, :]).sum(axis=1) * spots**2
+    profile = pd.DataFrame({"spot": spots, "gex": total})
+
+    cross = np.nonzero(np.diff(np.sign(total)) != 0)[0]
+    flip = np.nan
+    if cross.size:
+        i = cross[np.argmin(np.abs(spots[cross] - S))]
+        flip = spots[i] - total[i] * (spots[i + 1] - spots[i]) / (total[i + 1] - total[i])
+    return by_strike, profile, flip
+
+def plot_gex(S, by_strike, profile, flip, width_pct=0.08):
+    """上：各履約價淨 GEX (億)；下：spot 網格上的總 GEX 曲線與零 Gamma 點。"""
+    bs = by_strike[(by_strike["strike_price"] >= S * (1 - width_pct)) & (by_strike["strike_price"] <= S * (1 + width_pct))]
+    fig = make_subplots(rows=2, cols=1, shared_xaxes=True, vertical_spacing=0.06, row_heights=[0.55, 0.45])
+    fig.add_trace(go.Bar(x=bs["strike_price"], y=bs["gex"] / 1e8, name="淨 GEX (履約價)",
+                         marker_color=np.where(bs["gex"] >= 0, "#FF6B6B", "#4ECDC4")), row=1, col=1)
+    fig.add_trace(go.Scatter(x=profile["spot"], y=profile["gex"] / 1e8, name="總 GEX (假設現價)",
+                             line=dict(color="#FFA500")), row=2, col=1)
+    fig.add_hline(y=0, line_dash="dash", line_color="gray", row=2, col=1)
+    fig.add_vline(x=S, line_dash="dash", line_color="gray")
+    if np.isfinite(flip):
+        fig.add_vline(x=flip, line_dash="dot", line_color="purple", annotation_text="Zero Gamma", annotation_position="top")
+    fig.update_layout(title="造市商 Gamma 曝險 (億元 / 1%)", height=380, showlegend=False, margin=dict(l=0,r=0,t=30,b=0))
+    return fig
 
-def plot_payoff(K, premium, cp):
-    x_range = np.linspace(K * 0.9, K * 1.1, 100)
-    profit = []
-    for spot in x_range:
-        val = (max(0, spot - K) - premium) if cp == "CALL" else (max(0, K - spot) - premium)
-        profit.append(val * 50)
+# ---- 歷史 IV 庫：TXO 全鏈日資料多年回補 + 每日各到期 ATM IV (期限結構)，算 IV Rank / 百分位 ----
+IV_HISTORY_YEARS = 3
+IV_BACKFILL_CHUNKS = 12      # 每次執行最多往回補幾段 TXO (一段 10 天)，多年歷史分多次補完
+IV_CM_TDAYS = 21             # 固定天期 (約一個月) ATM IV，作為 IV Rank 的基準序列
+IV_RANK_WINDOW = 252
+IV_TERM_COLS = ["contract_date", "expiry", "tdays", "T", "strike_price", "forward", "atm_iv"]
+
+def _atm_term(day, chain, r=0.02):
+    """單日期限結構：每個到期日取 |C-P| 最小的履約價，以買賣權平價推 forward，call/put IV 平均為 ATM IV。"""
+    df = _prepare_chain(day, chain)
+    df = df[(df["strike_price"] > 0) & (df["settle"] > 0) & df["call_put"].isin(["CALL", "PUT"])]
+    if df.empty: return pd.DataFrame()
+    px_ = df.pivot_table(index=["contract_date", "strike_price"], columns="call_put", values="settle", aggfunc="last")
+    px_ = px_.reindex(columns=["CALL", "PUT"]).dropna()
+    if px_.empty: return pd.DataFrame()
+    atm = px_.loc[(px_["CALL"] - px_["PUT"]).abs().groupby(level="contract_date").idxmin()].reset_index()
+    atm = atm.join(df.groupby("contract_date")[["expiry", "tdays", "T"]].first(), on="contract_date")
+    T, K = atm["T"].to_numpy(), atm["strike_price"].to_numpy()
+    forward = K + (atm["CALL"].to_numpy() - atm["PUT"].to_numpy()) * np.exp(r * T)
+    spot = forward * np.exp(-r * T)
+    iv = implied_vol_chain(np.r_[atm["CALL"], atm["PUT"]], np.r_[spot, spot], np.r_[K, K], np.r_[T, T], r,
+                           np.r_[np.ones(len(atm), bool), np.zeros(len(atm), bool)])
+    atm["forward"] = forward
+    atm["atm_iv"] = pd.DataFrame(iv.reshape(2, -1)).mean().to_numpy()   # 單邊解不出時取另一邊
+    return atm[IV_TERM_COLS].dropna(subset=["atm_iv"])
+
+def update_iv_terms(txo, ivs):
+    """對 TXO_IV 還沒有的交易日 (加上最新一天，可能補了夜盤) 算期限結構；一次只讀一個月分區。
+    解不出 ATM IV 的日子寫一列 atm_iv=NaN 的佔位，之後不再重算 (讀取端會濾掉)。"""
+    done = set(ivs.dates())
+    days = txo.dates()
+    todo = sorted({d for d in days if d not in done} | set(days[-1:]))
+    for _, month_days in pd.Series(todo).groupby(pd.Series(todo).str[:7]):
+        month_days = list(month_days)
+        raw = txo.read(month_days[0], month_days[-1])
+        if raw.empty: continue
+        raw = raw[raw["date"].isin(month_days)]
+        if "trading_session" in raw.columns:
+            raw = raw[raw["trading_session"].astype(str) == "position"]
+        chains = dict(tuple(raw.groupby("date")))
+        for day in month_days:
+            term = _atm_term(day, chains[day]) if day in chains else pd.DataFrame()
+            if term.empty:
+                term = pd.DataFrame([{c: (np.nan if c not in ("contract_date", "expiry") else "") for c in IV_TERM_COLS}])
+            else:
+                term["expiry"] = term["expiry"].dt.strftime("%Y-%m-%d")
+            ivs.put_day(day, term.assign(date=day))
+
+def _iv_backfill_worker(job, txo, ivs, fetch, chunk_days, start):
+    """背景執行緒：每回補 IV_BACKFILL_CHUNKS 段就更新一次 IV，直到涵蓋 start 或上游不再前進。"""
+    try:
+        prev = None
+        while True:
+            covered = txo.backfill(start, fetch, chunk_days, IV_BACKFILL_CHUNKS)
+            update_iv_terms(txo, ivs)
+            if covered is None or covered <= start or covered == prev: break
+            prev = covered
+        job["error"] = None
+    except Exception as e:
+        job["error"] = str(e)
+    job["finished_at"] = _epoch_now()
+
+@st.cache_resource(show_spinner=False)
+def get_iv_backfill():
+    """每個進程一個 TXO 歷史回補工作 (跨 session 共用)。"""
+    return {"lock": threading.Lock(), "thread": None, "error": None, "finished_at": 0.0}
+
+def start_iv_backfill(token):
+    """頁面只觸發、不等待：TXO 多年回補 + 歷史 IV 計算在背景執行緒跑。
+    已在跑、或上次跑完未滿 STORE_RECHECK_SEC 就不重複啟動；store / FinMind 連線在 script 執行緒取好再交給背景執行緒。"""
+    job = get_iv_backfill()
+    with job["lock"]:
+        if job["thread"] is not None and job["thread"].is_alive(): return
+        if _epoch_now() - job["finished_at"] < STORE_RECHECK_SEC: return
+        fetch, chunk_days = STORE_DATASETS["TXO"]
+        dl = get_finmind(token)
+        start = (date.today() - timedelta(days=365 * IV_HISTORY_YEARS)).strftime("%Y-%m-%d")
+        th = threading.Thread(target=_iv_backfill_worker, daemon=True,
+                              args=(job, get_daily_store("TXO"), get_daily_store("TXO_IV"), lambda a, b: fetch(dl, a, b), chunk_days, start))
+        job["thread"] = th
+        th.start()
+
+def _constant_maturity_iv(term, tdays=IV_CM_TDAYS):
+    """各日依總變異數 (iv²·T) 對 T 線性內插到固定天期；超出兩端時取最近到期的 IV。"""
+    target = tdays / TRADING_DAYS_PER_YEAR
+    out = {}
+    for day, g in term.groupby("date"):
+        g = g.sort_values("T")
+        T, iv = g["T"].to_numpy(float), g["atm_iv"].to_numpy(float)
+        if target <= T[0]: out[day] = iv[0]
+        elif target >= T[-1]: out[day] = iv[-1]
+        else: out[day] = np.sqrt(np.interp(target, T, iv**2 * T) / target)
+    return pd.Series(out, name="atm_iv")
+
+def get_iv_history(token):
+    """回傳 (daily, term)：daily 為每日固定天期 ATM IV + 滾動 IV Rank / 百分位；term 為各日各到期 ATM IV。
+    先觸發背景回補，再以 IV 庫目前版本 (最後日期/天數) 為快取鍵，回補有進度時自然換新，不會卡住空結果。"""
+    start_iv_backfill(token)
+    days = get_daily_store("TXO_IV").dates()
+    return _iv_history(f"{days[-1] if days else ''}/{len(days)}")
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def _iv_history(version):
+    start = (date.today() - timedelta(days=365 * IV_HISTORY_YEARS)).strftime("%Y-%m-%d")
+    term = get_daily_store("TXO_IV").read(start)
+    if not term.empty: term = term.dropna(subset=["atm_iv"]).reset_index(drop=True)   # 去掉解不出 IV 的佔位列
+    if term.empty: return pd.DataFrame(columns=["date", "atm_iv", "iv_rank", "iv_pct"]), term
+    term["date"] = pd.to_datetime(term["date"])
+    cm = _constant_maturity_iv(term).sort_index()
+    roll = cm.rolling(IV_RANK_WINDOW, min_periods=20)
+    lo, hi = roll.min(), roll.max()
+    daily = pd.DataFrame({"date": cm.index, "atm_iv": cm.to_numpy(),
+                          "iv_rank": ((cm - lo) / (hi - lo)).to_numpy() * 100,
+                          "iv_pct": roll.rank(pct=True).to_numpy() * 100})
+    return daily.reset_index(drop=True), term
+
+def iv_regime(daily):
+    """最新一天的 IV 溫度：{iv, rank, pct, label, n}；資料不足時回傳 None。"""
+    if daily is None or daily.empty or pd.isna(daily["iv_pct"].iloc[-1]): return None
+    last = daily.iloc[-1]
+    label = "🟢 便宜" if last["iv_pct"] < 30 else ("🔴 昂貴" if last["iv_pct"] > 70 else "🟡 合理")
+    return {"iv": last["atm_iv"], "rank": last["iv_rank"], "pct": last["iv_pct"], "label": label,
+            "n": int(min(len(daily), IV_RANK_WINDOW))}
+
+# ---- 平行工具：多進程 (forkserver / spawn) 跑 CPU 密集工作，不支援或失敗時依序執行 ----
+PARALLEL_MAX_WORKERS = 2   # 共用主機上限；每個子進程各自持有一份工作記憶體
+
+def map_parallel(fn, tasks, use_processes=False, max_workers=PARALLEL_MAX_WORKERS):
+    """fn 必須來自可匯入的 sim_workers 模組、tasks 需可 pickle。Streamlit server 是多執行緒進程，
+    不用 fork (可能卡在其他執行緒持有的鎖)；改用 forkserver (無則 spawn) 由乾淨的進程產生子進程。
+    預設依序執行；任何錯誤都退回依序執行，結果順序與 tasks 相同。"""
+    tasks = list(tasks)
+    if use_processes and len(tasks) > 1 and fn.__module__ != "__main__":
+        try:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            workers = max(1, min(max_workers, os.cpu_count() or 1, len(tasks)))
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method)) as ex:
+                return list(ex.map(fn, tasks))
+        except Exception:
+            pass
+    return [fn(t) for t in tasks]
+
+# ---- LEAPS 選約規則回測：歷史每一天重播掃描器規則 (全期向量化選約)，持有到到期或觸發出場 ----
+WIN_TOP_FRAC = 0.4
+
+def win_rate_from_rank(rank, n):
+    """掃描器分段勝率：rank 為同組內 raw_score 由高到低的名次 (0 起算)，n 為同組筆數；
+    前 40% 線性映射 95 -> 90，其餘 85 -> 15。"""
+    rank, n = np.asarray(rank, dtype=float), np.asarray(n, dtype=float)
+    top = np.maximum(1, np.floor(n * WIN_TOP_FRAC))
+    top_score = np.where(top > 1, 95.0 - rank / np.maximum(top - 1, 1) * 5.0, 95.0)
+    remain = n - top
+    low_score = np.where(remain > 1, 85.0 - (rank - top) / np.maximum(remain - 1, 1) * 70.0, 15.0)
+    return np.round(np.where(rank < top, top_score, low_score), 1)
+
+@st.cache_resource(ttl=3600, show_spinner=False)
+def get_txo_panel(token):
+    """歷史 TXO 全鏈 (一般盤)，每列帶到期日/剩餘交易日/T 與當日 TAIEX 收盤 (S)。
+    資料量大，以 cache_resource 共用同一份 (呼叫端勿修改)。"""
+    get_iv_history(token)   # 順便觸發 TXO 歷史背景回補 (未補完時只用已有的部分)
+    start = (date.today() - timedelta(days=365 * IV_HISTORY_YEARS)).strftime("%Y-%m-%d")
+    raw = get_daily_store("TXO").read(start)
+    if raw.empty: return pd.DataFrame()
+    if "trading_session" in raw.columns:
+        raw = raw[raw["trading_session"].astype(str) == "position"]
+    df = _clean_chain(raw)
+    df["date"] = pd.to_datetime(raw["date"])
+    df = df[(df["strike_price"] > 0) & df["call_put"].isin(["CALL", "PUT"])]
+
+    expiry = {c: contract_expiry(c) for c in pd.unique(df["contract_date"])}
+    df["expiry"] = pd.to_datetime(df["contract_date"].map(lambda c: expiry[c]))
+    df = df[df["expiry"].notna() & (df["expiry"] >= df["date"])]
+    d0, d1 = df["date"].to_numpy("datetime64[D]"), df["expiry"].to_numpy("datetime64[D]")
+    df["tdays"] = np.maximum(np.busday_count(d0, d1, busdaycal=TW_BUSDAY_CAL), 1)
+    df["days"] = np.maximum((d1 - d0).astype(int), 1)
+    df["T"] = df["tdays"] / TRADING_DAYS_PER_YEAR
+
+    taiex = get_taiex_frame(token)
+    if not taiex.empty:
+        df["S"] = df["date"].map(taiex.set_index("date")["close"])
+    else:
+        df["S"] = np.nan
+    return df[df["S"].notna()].sort_values(["date", "contract_date", "call_put", "strike_price"]).reset_index(drop=True)
+
+def select_leaps(panel, op_type, target_lev, r=0.02):
+    """全期一次重播掃描器：每天取該方向最遠月，sigma 與 get_greeks_table 相同 (當日同月同方向有成交合約
+    反推 IV、依履約價內插，無成交用 IV_DEFAULT)，再交給 rank_candidates (以日期分組) 取每天第一名。"""
+    side = panel[panel["call_put"] == op_type]
+    side = side[side["expiry"] == side.groupby("date")["expiry"].transform("max")].reset_index(drop=True)
+    if side.empty: return pd.DataFrame()
+    S, K, T = side["S"].to_numpy(float), side["strike_price"].to_numpy(float), side["T"].to_numpy(float)
+    close, vol, is_call = side["close"].to_numpy(float), side["volume"].to_numpy(float), op_type == "CALL"
+
+    # 逐列反推 IV 與其他列無關，全期一次算完；再逐日做 smile_sigma 的履約價內插
+    iv = np.full(len(side), np.nan)
+    obs = (vol > 0) & (close > 0)
+    iv[obs] = implied_vol_chain(close[obs], S[obs], K[obs], T[obs], r, is_call)
+    sigma = np.full(len(side), IV_DEFAULT)
+    for idx in side.groupby("date").indices.values():
+        m = idx[np.isfinite(iv[idx])]
+        if m.size == 0: continue
+        sm = pd.Series(iv[m]).groupby(K[m]).mean()
+        sigma[idx] = np.interp(K[idx], sm.index.to_numpy(float), sm.to_numpy(float))
+
+    g = bs_greeks(S, K, T, r, sigma, is_call)
+    price = np.where(vol > 0, close, g["price"])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lev = np.where(price > 0, np.abs(g["delta"]) * S / price, 0.0)
+    c = pd.DataFrame({"date": side["date"].to_numpy(), "contract_date": side["contract_date"].to_numpy(),
+                      "strike_price": K, "price": price, "delta": g["delta"], "leverage": lev,
+                      "days": side["days"].to_numpy(), "raw_score": calculate_raw_score(g["delta"], side["days"].to_numpy(), vol, S, K, is_call)})
+    ranked = rank_candidates(c, target_lev, top_k=None, by=("date",))
+    return ranked.drop_duplicates("date").sort_values("date").reset_index(drop=True)
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def get_leaps_backtest(data_key, op_type, target_lev, entry_every, take_profit, stop_loss, max_hold, use_processes, _panel):
+    """data_key 為歷史資料版本 (最後日期/筆數)。每 entry_every 個交易日依掃描器規則買 1 口；
+    按合約月份分組模擬 (可多進程)。回傳 (trades, equity)，equity 為累積損益 (元) 的日序列。"""
+    picks = select_leaps(_panel, op_type, target_lev)
+    if picks.empty: return pd.DataFrame(), pd.Series(dtype=float)
+    all_days = np.sort(_panel["date"].unique())
+    entry_days = all_days[::max(int(entry_every), 1)]
+    picks = picks[picks["date"].isin(entry_days)]
+    side = _panel[_panel["call_put"] == op_type]
+    tasks = []
+    for con, pk in picks.groupby("contract_date"):
+        m = side[side["contract_date"] == con]
+        path = m.pivot_table(index="date", columns="strike_price", values="settle", aggfunc="last").sort_index().ffill()
+        tasks.append((path, pk, m["expiry"].iloc[0], take_profit, stop_loss, max_hold, TXO_MULTIPLIER))
+    results = map_parallel(simulate_month, tasks, use_processes)
+    trades = pd.DataFrame([t for res in results for t in res[0]])
+    pnl = pd.Series(np.concatenate([res[2] for res in results]), index=np.concatenate([res[1] for res in results]))
+    equity = pnl.groupby(level=0).sum().reindex(all_days, fill_value=0.0).cumsum()
+    if not trades.empty: trades = trades.sort_values("進場日").reset_index(drop=True)
+    return trades, equity
+
+# ---- 投組風險：各腿 greeks 加總 + spot × IV × 經過天數 三維情境損益 (全部廣播，無迴圈) ----
+def bs_price(S, K, T, r, sigma, is_call):
+    """只算價格 (情境/損益圖用，比 bs_greeks 省)；T<=0 時回傳到期內含價值。"""
+    S, K, T, sigma = (np.asarray(x, dtype=float) for x in (S, K, T, sigma))
+    is_call = np.asarray(is_call, dtype=bool)
+    live = (T > 0) & (sigma > 0)
+    T_, sig_ = np.where(live, T, 1.0), np.where(live, sigma, 1.0)
+    vol_t = sig_ * np.sqrt(T_)
+    d1 = (np.log(S / K) + (r + 0.5 * sig_**2) * T_) / vol_t
+    d2 = d1 - vol_t
+    disc_k = K * np.exp(-r * T_)
+    call = S * ndtr(d1) - disc_k * ndtr(d2)
+    price = np.where(is_call, call, call - S + disc_k)          # put 由買賣權平價推得，少算一半 CDF
+    intrinsic = np.where(is_call, np.maximum(S - K, 0.0), np.maximum(K - S, 0.0))
+    return np.where(live, price, intrinsic)
+
+def portfolio_legs(portfolio, greeks, date_key):
+    """把掃描器存下的合約 (dict list) 轉成腿表：K, is_call, qty (+買/-賣), premium, iv, T。
+    iv/T 取當日 greeks 表；查不到時用 IV_DEFAULT 與合約到期日推算。"""
+    rows = []
+    for p in portfolio:
+        con, cp, K = str(p["合約"]), p["類型"], float(p["履約價"])
+        iv, T = IV_DEFAULT, np.nan
+        key = (con, cp)
+        if greeks is not None and key in greeks.index:
+            hit = greeks.loc[[key]]
+            hit = hit[hit["strike_price"] == K]
+            if not hit.empty: iv, T = float(hit["iv"].iloc[0]), float(hit["T"].iloc[0])
+        if not np.isfinite(T):
+            exp = contract_expiry(con)
+            T = max(int(np.busday_count(np.datetime64(date_key, "D"), exp, busdaycal=TW_BUSDAY_CAL)), 1) / TRADING_DAYS_PER_YEAR \
+                if exp is not None else 0.0
+        rows.append({"contract": con, "K": K, "is_call": cp == "CALL", "qty": float(p.get("口數", 1)),
+                     "premium": float(p["價格"]), "iv": iv, "T": T})
+    return pd.DataFrame(rows)
+
+def portfolio_greeks(legs, S, r=0.02):
+    """投組總 greeks (已乘口數與契約乘數 50)：delta 為每點元、gamma 為每點 delta 變化、vega 每 1% IV、theta 每交易日。"""
+    if legs.empty: return {k: 0.0 for k in ["delta", "gamma", "vega", "theta"]}
+    g = bs_greeks(S, legs["K"].to_numpy(), legs["T"].to_numpy(), r, legs["iv"].to_numpy(), legs["is_call"].to_numpy())
+    w = legs["qty"].to_numpy() * TXO_MULTIPLIER
+    return {k: float((g[k] * w).sum()) for k in ["delta", "gamma", "vega", "theta"]}
+
+def scenario_grid(legs, S, spot_pct, vol_shift, days_fwd, r=0.02):
+    """三維情境損益 (元)：形狀 (len(spot_pct), len(vol_shift), len(days_fwd))。
+    spot_pct 為相對現價漲跌幅、vol_shift 為 IV 絕對加減 (0.05 = +5 vol)、days_fwd 為經過交易日數。"""
+    spot = S * (1 + np.asarray(spot_pct, dtype=float))[:, None, None, None]
+    sigma = np.maximum(legs["iv"].to_numpy()[None, None, None, :] + np.asarray(vol_shift, dtype=float)[None, :, None, None], 0.01)
+    T = np.maximum(legs["T"].to_numpy()[None, None, None, :] - np.asarray(days_fwd, dtype=float)[None, None, :, None] / TRADING_DAYS_PER_YEAR, 0.0)
+    px_ = bs_price(spot, legs["K"].to_numpy(), T, r, sigma, legs["is_call"].to_numpy())
+    return ((px_ - legs["premium"].to_numpy()) * legs["qty"].to_numpy() * TXO_MULTIPLIER).sum(axis=-1)
+
+# ---- 多腿損益引擎：任意腿數 × 任意解析度指數網格一次廣播；到期損益為分段線性，損益兩平 / 最大損益解析求解 ----
+def payoff_curve(legs, spot, days_fwd=None, r=0.02):
+    """legs 為 portfolio_legs 格式 (K, is_call, qty 買+賣-, premium；到期前曲線另需 iv, T)。
+    回傳 (到期損益, 到期前損益) 元、形狀同 spot；days_fwd=None 時不算到期前曲線，否則以 BS 定價 days_fwd 交易日後的損益。"""
+    s = np.asarray(spot, dtype=float)[..., None]
+    K, is_call = legs["K"].to_numpy(dtype=float), legs["is_call"].to_numpy(dtype=bool)
+    w = legs["qty"].to_numpy(dtype=float) * TXO_MULTIPLIER
+    prem = legs["premium"].to_numpy(dtype=float)
+    intrinsic = np.where(is_call, np.maximum(s - K, 0.0), np.maximum(K - s, 0.0))
+    expiry = ((intrinsic - prem) * w).sum(axis=-1)
+    if days_fwd is None: return expiry, None
+    T = np.maximum(legs["T"].to_numpy(dtype=float) - days_fwd / TRADING_DAYS_PER_YEAR, 0.0)
+    live = ((bs_price(s, K, T, r, legs["iv"].to_numpy(dtype=float), is_call) - prem) * w).sum(axis=-1)
+    return expiry, live
+
+def payoff_stats(legs):
+    """到期損益的解析特徵 (元)：損益兩平點、最大獲利 / 最大虧損 (無上限為 ±inf)。
+    到期損益在 [0, ∞) 上是以履約價為折點的分段線性函數，只需折點上的值與最右段斜率 (= call 淨口數)。"""
+    if legs.empty: return {"breakevens": np.array([]), "max_profit": 0.0, "max_loss": 0.0}
+    knots = np.concatenate([[0.0], np.unique(legs["K"].to_numpy(dtype=float))])
+    vals, _ = payoff_curve(legs, knots)
+    slope = float(legs["qty"].to_numpy(dtype=float)[legs["is_call"].to_numpy(dtype=bool)].sum() * TXO_MULTIPLIER)
+    v0, v1 = vals[:-1], vals[1:]
+    cross = v0 * v1 < 0                                   # 相鄰折點間變號 -> 線性內插
+    roots = knots[:-1][cross] - v0[cross] * np.diff(knots)[cross] / (v1[cross] - v0[cross])
+    roots = np.concatenate([roots, knots[vals == 0]])
+    if slope != 0 and vals[-1] * slope < 0:               # 最右段往 0 走：最後一個折點之後還有一根
+        roots = np.append(roots, knots[-1] - vals[-1] / slope)
+    return {"breakevens": np.unique(roots),
+            "max_profit": np.inf if slope > 0 else float(vals.max()),
+            "max_loss": -np.inf if slope < 0 else float(vals.min())}
+
+def plot_payoff(legs, S, days_fwd=0, n_grid=801, width_pct=0.1, title="損益圖"):
+    """到期損益 (實線填色) + days_fwd 交易日後理論損益 (虛線，需 iv/T) + 損益兩平點。"""
+    stats = payoff_stats(legs)
+    K = legs["K"].to_numpy(dtype=float)
+    lo = min(S * (1 - width_pct), K.min() * 0.98) if len(K) else S * (1 - width_pct)
+    hi = max(S * (1 + width_pct), K.max() * 1.02) if len(K) else S * (1 + width_pct)
+    x = np.linspace(lo, hi, n_grid)
+    has_live = days_fwd is not None and {"iv", "T"} <= set(legs.columns)
+    expiry, live = payoff_curve(legs, x, days_fwd if has_live else None)
     fig = go.Figure()
-    fig.add_trace(go.Scatter(x=x_range, y=profit, mode='lines', fill='tozeroy', 
-                             line=dict(color='green' if profit[-1]>0 else 'red')))
+    fig.add_trace(go.Scatter(x=x, y=np.where(expiry >= 0, expiry, np.nan), mode='lines', fill='tozeroy', name="到期 (獲利)",
+                             line=dict(color='green')))
+    fig.add_trace(go.Scatter(x=x, y=np.where(expiry <= 0, expiry, np.nan), mode='lines', fill='tozeroy', name="到期 (虧損)",
+                             line=dict(color='red')))
+    if live is not None:
+        fig.add_trace(go.Scatter(x=x, y=live, mode='lines', name=f"{days_fwd} 日後" if days_fwd else "今日理論",
+                                 line=dict(color='#FFA500', dash='dash')))
     fig.add_hline(y=0, line_dash="dash", line_color="gray")
-    fig.update_layout(title=f"到期損益圖 ({cp} @ {K})", xaxis_title="指數", yaxis_title="損益(TWD)", 
+    fig.add_vline(x=S, line_dash="dot", line_color="gray")
+    for be in stats["breakevens"]:
+        if lo <= be <= hi:
+            fig.add_vline(x=be, line_dash="dot", line_color="purple", annotation_text=f"{be:,.0f}", annotation_position="top")
+    fig.update_layout(title=title, xaxis_title="指數", yaxis_title="損益(TWD)", showlegend=False,
                       height=300, margin=dict(l=0,r=0,t=30,b=0))
-    return fig
+    return fig, stats
+
+def fmt_pnl(v):
+    return "無上限" if np.isposinf(v) else ("無下限" if np.isneginf(v) else f"{v:,.0f}")
+
+# ---- 價差篩選：同到期垂直價差 / 同履約價日曆價差，全部配對以履約價 × 履約價廣播矩陣一次評分，argpartition 取前 k ----
+SPREAD_MIN_PRICE = 0.5
+SPREAD_KINDS = {"bear_call": ("CALL", True), "bull_put": ("PUT", True),      # 收租 (credit)
+                "bull_call": ("CALL", False), "bear_put": ("PUT", False)}    # 付權利金 (debit)
+
+def _top_k(score, k):
+    k = min(k, len(score))
+    if k == 0: return np.array([], dtype=int)
+    idx = np.argpartition(-score, k - 1)[:k]
+    return idx[np.argsort(-score[idx])]
+
+def vertical_spreads(greeks, S, kind="bear_call", max_width=1000, min_pop=0.6, min_pts=5.0, top_k=20, r=0.02):
+    """各到期所有垂直價差 (賣腿, 買腿) 配對：淨權利金、寬度、最大損益、報酬風險比、獲利機率 (損益兩平 N(d2))、賣腿 OTM 機率 (1-|Δ|)。
+    只留獲利機率 >= min_pop、最大獲利與最大虧損皆 >= min_pts 點 (排除一兩點的深價外 / 深價內配對)；score = 獲利機率 × 報酬風險比。greeks 為 get_greeks_table 的表。"""
+    cp, credit = SPREAD_KINDS[kind]
+    cols = ["contract_date", "expiry", "days", "short_K", "long_K", "net", "width", "max_profit", "max_loss", "ror", "pop", "short_otm", "score"]
+    if greeks is None or greeks.empty: return pd.DataFrame(columns=cols)
+    side = greeks[greeks.index.get_level_values("call_put") == cp]
+    side = side[side["price"] > SPREAD_MIN_PRICE]
+    out = []
+    for con, g in side.groupby(level="contract_date"):
+        g = g.sort_values("strike_price")
+        K, p, d, iv = (g[c].to_numpy(dtype=float) for c in ["strike_price", "price", "delta", "iv"])
+        T = float(g["T"].iloc[0])
+        if len(K) < 2 or T <= 0: continue
+        # 列 i = 低履約價、欄 j = 高履約價；只取上三角 (j > i)、寬度 <= max_width、無套利 (0 < 淨權利金 < 寬度)
+        W = K[None, :] - K[:, None]
+        net = (p[:, None] - p[None, :]) if cp == "CALL" else (p[None, :] - p[:, None])   # credit 為收到、debit 為付出
+        ii, jj = np.nonzero((W > 0) & (W <= max_width) & (net > 0) & (net < W))
+        if len(ii) == 0: continue
+        w, n = W[ii, jj], net[ii, jj]
+        short, long_ = (ii, jj) if (cp == "CALL") == credit else (jj, ii)   # bear call / bear put 賣低履約價
+        max_profit, max_loss = (n, w - n) if credit else (w - n, n)
+        be = K[ii] + n if cp == "CALL" else K[jj] - n
+        sig = 0.5 * (iv[ii] + iv[jj])
+        d2 = (np.log(S / be) + (r - 0.5 * sig**2) * T) / (sig * np.sqrt(T))
+        above = (cp == "CALL") != credit                          # 需要收在損益兩平之上才獲利：bull call / bull put
+        pop = ndtr(d2) if above else ndtr(-d2)
+        ror = max_profit / max_loss
+        keep = (pop >= min_pop) & (np.minimum(max_profit, max_loss) >= min_pts)
+        if not keep.any(): continue
+        short, long_, n, w, max_profit, max_loss, ror, pop = (a[keep] for a in (short, long_, n, w, max_profit, max_loss, ror, pop))
+        out.append(pd.DataFrame({"contract_date": con, "expiry": g["expiry"].iloc[0], "days": int(g["days"].iloc[0]),
+                                 "short_K": K[short], "long_K": K[long_], "net": n, "width": w, "max_profit": max_profit * TXO_MULTIPLIER,
+                                 "max_loss": max_loss * TXO_MULTIPLIER, "ror": ror, "pop": pop, "short_otm": 1 - np.abs(d[short]),
+                                 "score": pop * ror}))
+    if not out: return pd.DataFrame(columns=cols)
+    res = pd.concat(out, ignore_index=True)
+    return res.iloc[_top_k(res["score"].to_numpy(), top_k)].reset_index(drop=True)[cols]
+
+def calendar_spreads(greeks, S, cp="CALL", width_pct=0.05, top_k=20):
+    """同履約價、賣近月買遠月：付出權利金、淨 theta (元/日，賣近月收的時間價值減去遠月流失)、近遠 IV 比。
+    履約價 × 近月 × 遠月 三維廣播；score = 淨 theta / 付出權利金。"""
+    cols = ["short_con", "long_con", "strike", "debit", "net_theta", "iv_ratio", "score"]
+    if greeks is None or greeks.empty: return pd.DataFrame(columns=cols)
+    side = greeks[(greeks.index.get_level_values("call_put") == cp) & (greeks["price"] > SPREAD_MIN_PRICE)
+                  & ((greeks["strike_price"] - S).abs() <= S * width_pct)].reset_index()
+    if side.empty: return pd.DataFrame(columns=cols)
+    cons = side.groupby("contract_date")["expiry"].first().sort_values().index
+    piv = {c: side.pivot_table(index="strike_price", columns="contract_date", values=c, aggfunc="first").reindex(columns=cons)
+           for c in ["price", "theta", "iv"]}
+    K = piv["price"].index.to_numpy(dtype=float)
+    P, TH, IV = (piv[c].to_numpy(dtype=float) for c in ["price", "theta", "iv"])   # (n_strike, n_exp)
+    debit = P[:, None, :] - P[:, :, None]                         # [k, 近 a, 遠 b]
+    net_theta = (TH[:, None, :] - TH[:, :, None]) * TXO_MULTIPLIER
+    near_before_far = np.arange(len(cons))[:, None] < np.arange(len(cons))[None, :]
+    ok = near_before_far[None] & np.isfinite(debit) & (debit > 0) & (net_theta > 0)
+    kk, aa, bb = np.nonzero(ok)
+    if len(kk) == 0: return pd.DataFrame(columns=cols)
+    res = pd.DataFrame({"short_con": cons[aa], "long_con": cons[bb], "strike": K[kk], "debit": debit[kk, aa, bb],
+                        "net_theta": net_theta[kk, aa, bb], "iv_ratio": IV[kk, aa] / IV[kk, bb]})
+    res["score"] = res["net_theta"] / (res["debit"] * TXO_MULTIPLIER)
+    return res.iloc[_top_k(res["score"].to_numpy(), top_k)].reset_index(drop=True)[cols]
+
+# 戰情室原始評分 (綜合因子)：純量或整條鏈陣列皆可；op_type 可為 "CALL"/"PUT" 或逐列 is_call 布林陣列
+def calculate_raw_score(delta, days, volume, S, K, op_type):
+    s_delta = np.abs(delta) * 100.0
+    is_call = (op_type == "CALL") if isinstance(op_type, str) else np.asarray(op_type, dtype=bool)
+    m = np.where(is_call, S - K, K - S) / S
+    s_money = np.clip(m * 100 * 2, -10, 10) + 50
+    s_time = np.minimum(np.asarray(days, dtype=float) / 90.0 * 100, 100)
+    s_vol = np.minimum(np.asarray(volume, dtype=float) / 5000.0 * 100, 100)
+    return s_delta * 0.4 + s_money * 0.2 + s_time * 0.2 + s_vol * 0.2
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def get_greeks_table(date_key, S, _chain, r=0.02):
+    """每個交易日一張 TXO 全鏈 greeks/指標表 (index = contract_date, call_put)，全站共用；掃描只做篩選與排序。
+    sigma 用同月同方向 IV 內插；無成交合約的 price 取理論價 (status=合理)。"""
+    cols = ["contract_date", "call_put", "strike_price", "close", "volume", "open_interest", "expiry", "days", "tdays", "T", "iv", "price", "status",
+            "delta", "gamma", "vega", "theta", "leverage", "raw_score"]
+    empty = pd.DataFrame(columns=cols).set_index(["contract_date", "call_put"])
+    if _chain is None or _chain.empty: return empty
+    df = _prepare_chain(date_key, _chain)
+    df = df[(df["strike_price"] > 0) & df["call_put"].isin(["CALL", "PUT"])].reset_index(drop=True)
+    if df.empty: return empty
+
+    iv_df = get_chain_iv(date_key, S, _chain, r)
+    df["iv"] = IV_DEFAULT
+    for (con, cp), idx in df.groupby(["contract_date", "call_put"]).groups.items():
+        df.loc[idx, "iv"] = smile_sigma(iv_df, con, cp, df.loc[idx, "strike_price"])
+
+    is_call = (df["call_put"] == "CALL").to_numpy()
+    g = bs_greeks(S, df["strike_price"].to_numpy(), df["T"].to_numpy(), r, df["iv"].to_numpy(), is_call)
+    traded = df["volume"].to_numpy() > 0
+    df["price"] = np.where(traded, df["close"], g["price"])
+    df["status"] = np.where(traded, "🟢成交", "🔵合理")
+    for k in ["delta", "gamma", "vega", "theta"]:
+        df[k] = g[k]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        df["leverage"] = np.where(df["price"] > 0, np.abs(df["delta"]) * S / df["price"], 0.0)
+    df["raw_score"] = calculate_raw_score(df["delta"].to_numpy(), df["days"].to_numpy(), df["volume"].to_numpy(), S,
+                                          df["strike_price"].to_numpy(), is_call)
+    return df[cols].set_index(["contract_date", "call_put"]).sort_index()
 
-def plot_oi_walls(current_price):
-    strikes = np.arange(int(current_price)-600, int(current_price)+600, 100)
-    np.random.seed(int(current_price)) 
-    call_oi = np.random.randint(2000, 15000, len(strikes))
-    put_oi = np.random.randint(2000, 15000, len(strikes))
+def calculate_win_rate(delta, days):
+    return min(max((abs(delta)*0.7 + 0.8*0.3)*100, 1), 99)
+
+# 掃描排序 (欄運算)：同組 raw_score 名次 -> 分段勝率，再依 (槓桿差距, -勝率, -天數) 字典序取前 k
+SCAN_MIN_PRICE, SCAN_MIN_DELTA = 0.5, 0.1
+
+def rank_candidates(cands, target_lev, top_k=15, by=("contract_date", "call_put")):
+    """cands 為 greeks 表 reset_index 後的列；先濾掉價格 <= 0.5、|Delta| < 0.1，
+    同組 (預設同月同方向) 依 raw_score 展開勝率 win，gap = |槓桿 - 目標|。
+    np.lexsort 一次排好 (gap, -win, -days)，同分保留 raw_score 高者在前 (與舊 dict 版兩段穩定排序一致)。"""
+    c = cands[(cands["price"] > SCAN_MIN_PRICE) & (cands["delta"].abs() >= SCAN_MIN_DELTA)]
+    if c.empty: return c.assign(win=pd.Series(dtype=float), gap=pd.Series(dtype=float))
+    grp = c.groupby(list(by), sort=False)["raw_score"]
+    win = win_rate_from_rank(grp.rank(ascending=False, method="first").to_numpy() - 1, grp.transform("size").to_numpy())
+    gap = np.abs(c["leverage"].to_numpy(dtype=float) - target_lev)
+    order = np.lexsort((-c["raw_score"].to_numpy(dtype=float), -c["days"].to_numpy(dtype=float), -win, gap))
+    return c.assign(win=win, gap=gap).iloc[order[:top_k]].reset_index(drop=True)
+
+def scan_all_expiries(greeks, target_lev, top_n=15):
+    """整條鏈 (所有到期 × CALL/PUT) 一次排序：勝率仍在各月各方向組內展開，與單月掃描結果一致。
+    回傳 (全域前 top_n, 各到期各方向最佳一檔 + 候選數)。"""
+    ranked = rank_candidates(greeks.reset_index(), target_lev, top_k=None)
+    if ranked.empty: return ranked, ranked
+    best = ranked.drop_duplicates(["contract_date", "call_put"])            # 已排序，第一筆即該組最佳
+    n = ranked.groupby(["contract_date", "call_put"]).size().rename("n")
+    best = best.join(n, on=["contract_date", "call_put"]).sort_values(["expiry", "call_put"]).reset_index(drop=True)
+    return ranked.head(top_n), best
+
+def plot_oi_walls(current_price, walls, contract, summary=None, width_pct=0.08):
+    """單一到期日的 OI 牆 (現價 ±width_pct)，標出現價與最大痛點。"""
+    w = walls.loc[[contract]] if contract in walls.index else walls.iloc[0:0]
+    w = w[(w["strike_price"] >= current_price * (1 - width_pct)) & (w["strike_price"] <= current_price * (1 + width_pct))]
     fig = go.Figure()
-    fig.add_trace(go.Bar(x=strikes, y=call_oi, name='Call OI (壓力)', marker_color='#FF6B6B'))
-    fig.add_trace(go.Bar(x=strikes, y=-put_oi, name='Put OI (支撐)', marker_color='#4ECDC4'))
-    fig.update_layout(title="籌碼戰場 (OI Walls)", barmode='overlay', height=300, margin=dict(l=0,r=0,t=30,b=0))
+    fig.add_trace(go.Bar(x=w["strike_price"], y=w["call_oi"], name='Call OI (壓力)', marker_color='#FF6B6B'))
+    fig.add_trace(go.Bar(x=w["strike_price"], y=-w["put_oi"], name='Put OI (支撐)', marker_color='#4ECDC4'))
+    fig.add_vline(x=current_price, line_dash="dash", line_color="gray")
+    if summary is not None and contract in summary.index:
+        fig.add_vline(x=summary.at[contract, "max_pain"], line_dash="dot", line_color="orange",
+                      annotation_text="Max Pain", annotation_position="top")
+    fig.update_layout(title=f"籌碼戰場 (OI Walls) {contract}", barmode='overlay', height=300, margin=dict(l=0,r=0,t=30,b=0))
     return fig
 
 # =========================================
@@ -424,7 +1811,6 @@ import plotly.express as px
 
 # ========= Helpers =========
 TAIPEI_TZ = pytz.timezone("Asia/Taipei")
-TW_HOLIDAYS = holidays.TW()
 
 ETF_LIST = ["0050", "006208", "00662", "00757", "00646"]
 
@@ -479,15 +1865,12 @@ with tabs[1]:
         data = {}
         try:
             # 1. 台股 (FinMind)
-            dl = DataLoader()
-            dl.login_by_token(api_token=FINMIND_TOKEN)
+            dl = get_finmind(FINMIND_TOKEN)
             
             # TAIEX
-            df_tw = dl.taiwan_stock_daily("TAIEX", start_date=(date.today()-timedelta(days=5)).strftime("%Y-%m-%d"))
-            if not df_tw.empty:
-                close = df_tw['close'].iloc[-1]
-                prev = df_tw['close'].iloc[-2]
-                change = (close - prev) / prev * 100
+            lv = get_taiex_levels(FINMIND_TOKEN)
+            if lv:
+                close, change = lv['close'], lv['chg_pct']
                 data['taiex'] = f"{close:,.0f}"
                 data['taiex_pct'] = f"{change:+.1f}%"
                 data['taiex_color'] = "#28a745" if change > 0 else "#dc3545"
@@ -576,16 +1959,14 @@ with tabs[1]:
                     'summary': str(row.get('description', ''))[:100] + '...'
                 })
         
-        import feedparser
-        for title, url in rss_sources.items():
-            try:
-                feed = feedparser.parse(url)
-                for entry in feed.entries[:3]:
-                    all_news.append({
-                        'title': str(entry.title), 'link': str(entry.link), 'source': title,
-                        'time': entry.get('published', 'N/A'), 'summary': str(entry.get('summary', ''))[:100] + '...'
-                    })
-            except: pass
+        try: feeds = fetch_rss_feeds(rss_sources)
+        except Exception: feeds = {}
+        for title, entries in feeds.items():
+            for entry in entries[:3]:
+                all_news.append({
+                    'title': entry['title'], 'link': entry['link'], 'source': title,
+                    'time': entry['published'], 'summary': entry['summary'][:100] + '...'
+                })
 
         # 3. AI 情緒與熱詞分析
         pos_keywords = ['上漲', '漲', '買', '多頭', '樂觀', '強勢', 'Bull', 'Rise', 'AI', '成長', '台積電', '營收', '創高']
@@ -730,146 +2111,99 @@ with tabs[2]:
     KEY_RES = "results_lev_v185"
     KEY_BEST = "best_lev_v185"
     KEY_PF = "portfolio_lev"
+    KEY_ALL = "breakdown_lev_v185"
 
     if KEY_RES not in st.session_state: st.session_state[KEY_RES] = []
+    if KEY_ALL not in st.session_state: st.session_state[KEY_ALL] = None
     if KEY_BEST not in st.session_state: st.session_state[KEY_BEST] = None
     if KEY_PF not in st.session_state: st.session_state[KEY_PF] = []
 
     st.markdown("### ♟️ **專業戰情室 (槓桿篩選 + 微觀勝率 + LEAPS CALL)**")
     col_search, col_portfolio = st.columns([1.3, 0.7])
 
-    # 1. 原始評分 (綜合因子)
-    def calculate_raw_score(delta, days, volume, S, K, op_type):
-        s_delta = abs(delta) * 100.0
-        
-        if op_type == "CALL": m = (S - K) / S
-        else: m = (K - S) / S
-        s_money = max(-10, min(m * 100 * 2, 10)) + 50
-        
-        s_time = min(days / 90.0 * 100, 100)
-        s_vol = min(volume / 5000.0 * 100, 100)
-        
-        raw = (s_delta * 0.4 + s_money * 0.2 + s_time * 0.2 + s_vol * 0.2)
-        return raw
-
-    # 2. 微觀展開 (Top 40% -> 90-95%)
-    def micro_expand_scores(results):
-        if not results: return []
-        results.sort(key=lambda x: x['raw_score'], reverse=True)
-        n = len(results)
-        top_n = max(1, int(n * 0.4)) 
-        
-        for i in range(n):
-            if i < top_n:
-                if top_n > 1: score = 95.0 - (i / (top_n - 1)) * 5.0
-                else: score = 95.0
-            else:
-                remain = n - top_n
-                if remain > 1:
-                    idx = i - top_n
-                    score = 85.0 - (idx / (remain - 1)) * 70.0
-                else: score = 15.0
-            results[i]['勝率'] = round(score, 1)
-        return results
+    # 排序後的候選列 -> 結果卡 / 投組使用的 dict (勝率已由 rank_candidates 依 Top 40% -> 90-95% 展開)
+    def to_scan_records(top):
+        return [{
+            "履約價": int(row.strike_price),
+            "價格": float(row.price),
+            "狀態": row.status,
+            "槓桿": float(row.leverage),
+            "Delta": float(row.delta),
+            "raw_score": float(row.raw_score),
+            "Vol": int(row.volume),
+            "差距": float(row.gap),
+            "合約": str(row.contract_date),
+            "類型": row.call_put,
+            "天數": int(row.days),
+            "勝率": float(row.win)
+        } for row in top.itertuples(index=False)]
 
     with col_search:
         st.markdown("#### 🔍 **槓桿掃描 (LEAPS CALL 優化)**")
         
         if df_latest.empty: st.error("⚠️ 無資料"); st.stop()
-        
-        df_work = df_latest.copy()
-        df_work['call_put'] = df_work['call_put'].str.upper().str.strip()
-        for col in ['close', 'volume', 'strike_price']:
-            df_work[col] = pd.to_numeric(df_work[col], errors='coerce').fillna(0)
+
+        try:
+            iv_now = iv_regime(get_iv_history(FINMIND_TOKEN)[0])
+        except:
+            iv_now = None
+        if iv_now:
+            st.caption(f"🌡️ 權利金溫度：{iv_now['label']} | ATM IV {iv_now['iv']*100:.1f}% | "
+                       f"IV Rank {iv_now['rank']:.0f} | IV 百分位 {iv_now['pct']:.0f}% (近 {iv_now['n']} 日)")
 
         c1, c2, c3, c4 = st.columns([1, 1, 1, 0.6])
         with c1:
             dir_mode = st.selectbox("方向", ["📈 CALL (LEAPS)", "📉 PUT"], 0, key="v185_dir")
             op_type = "CALL" if "CALL" in dir_mode else "PUT"
+        greeks = get_greeks_table(str(latest_date.date()), S_current, df_latest)
         with c2:
-            contracts = df_work[df_work['call_put']==op_type]['contract_date'].dropna()
-            available = sorted(contracts[contracts.astype(str).str.len()==6].unique())
+            # 月選 + 週選，依真實結算日排序
+            side = greeks[greeks.index.get_level_values("call_put") == op_type]
+            expiry_of = side.groupby(level="contract_date")["expiry"].first().sort_values()
+            available = list(expiry_of.index)
             # ✅ 預設遠月合約 (LEAPS CALL 偏好)
             default_idx = len(available) - 1 if available else 0
             sel_con = st.selectbox("月份", available if available else [""], 
-                                 index=default_idx, key="v185_con")
+                                 index=default_idx, key="v185_con",
+                                 format_func=lambda c: f"{c} ({expiry_of[c]:%m/%d})" if c in expiry_of.index else c)
         with c3:
             target_lev = st.slider("目標槓桿", 2.0, 20.0, 5.0, 0.5, key="v185_lev")
         with c4:
             if st.button("🧹 重置", key="v185_reset"):
                 st.session_state[KEY_RES] = []
                 st.session_state[KEY_BEST] = None
+                st.session_state[KEY_ALL] = None
                 st.rerun()
+        scan_all = st.checkbox("🌐 全鏈掃描 (所有到期 × CALL/PUT，忽略方向與月份)", False, key="v185_all")
 
         if st.button("🚀 執行掃描", type="primary", use_container_width=True, key="v185_scan"):
             st.session_state[KEY_RES] = []
             st.session_state[KEY_BEST] = None
+            st.session_state[KEY_ALL] = None
             
-            if sel_con and len(str(sel_con))==6:
-                tdf = df_work[(df_work["contract_date"].astype(str)==sel_con) & (df_work["call_put"]==op_type)]
+            if scan_all:
+                # 同一張 greeks 表一次排序全部到期與雙向，另附各到期最佳一檔
+                top_all, by_expiry = scan_all_expiries(greeks, target_lev, top_n=15)
+                final_results = to_scan_records(top_all)
+                if final_results:
+                    st.session_state[KEY_RES] = final_results
+                    st.session_state[KEY_BEST] = final_results[0]
+                    st.session_state[KEY_ALL] = by_expiry
+                    st.success(f"全鏈掃描完成！{by_expiry['n'].sum()} 檔候選 / {by_expiry['contract_date'].nunique()} 個到期，"
+                               f"最佳槓桿：{final_results[0]['槓桿']:.1f}x")
+                else: st.warning("無符合資料")
+            elif sel_con:
+                # 當日全鏈 greeks 表已預先算好，這裡只做索引 + 篩選
+                key = (str(sel_con), op_type)
+                tdf = greeks.loc[[key]].reset_index() if key in greeks.index else greeks.iloc[0:0]
                 
                 if tdf.empty: st.warning("無資料")
                 else:
-                    try:
-                        y, m = int(str(sel_con)[:4]), int(str(sel_con)[4:6])
-                        days = max((date(y,m,15)-latest_date.date()).days, 1)
-                        T = days / 365.0
-                    except: st.error("日期解析失敗"); st.stop()
-
-                    raw_results = []
-                    for _, row in tdf.iterrows():
-                        try:
-                            K = float(row["strike_price"])
-                            vol = float(row["volume"])
-                            close_p = float(row["close"])
-                            if K<=0: continue
-                            
-                            try:
-                                r, sigma = 0.02, 0.2
-                                d1 = (np.log(S_current/K)+(r+0.5*sigma**2)*T)/(sigma*np.sqrt(T))
-                                
-                                if op_type=="CALL":
-                                    delta = norm.cdf(d1)
-                                    bs_p = S_current*norm.cdf(d1)-K*np.exp(-r*T)*norm.cdf(d1-sigma*np.sqrt(T))
-                                else:
-                                    delta = -norm.cdf(-d1)
-                                    bs_p = K*np.exp(-r*T)*norm.cdf(-(d1-sigma*np.sqrt(T)))-S_current*norm.cdf(-d1)
-                            except: 
-                                delta, bs_p = 0.5, close_p
-
-                            P = close_p if vol > 0 else bs_p
-                            if P <= 0.5: continue
-                            lev = (abs(delta)*S_current)/P
-                            
-                            if abs(delta) < 0.1: continue
-
-                            # 1. 原始分
-                            raw_score = calculate_raw_score(delta, days, vol, S_current, K, op_type)
-                            status = "🟢成交" if vol > 0 else "🔵合理"
-
-                            raw_results.append({
-                                "履約價": int(K), 
-                                "價格": P, 
-                                "狀態": status, 
-                                "槓桿": lev,
-                                "Delta": delta,
-                                "raw_score": raw_score,
-                                "Vol": int(vol),
-                                "差距": abs(lev - target_lev),
-                                "合約": sel_con, 
-                                "類型": op_type,
-                                "天數": days  # 新增，用於排序
-                            })
-                        except: continue
+                    # 勝率展開 + (槓桿差距, -勝率, -天數) 字典序前 15，全為欄運算
+                    final_results = to_scan_records(rank_candidates(tdf, target_lev, top_k=15))
                     
-                    if raw_results:
-                        # 2. 微觀展開勝率
-                        final_results = micro_expand_scores(raw_results)
-                        
-                        # 3. 排序：優先找槓桿最接近的，其次看勝率，最後天數（遠月優先）
-                        final_results.sort(key=lambda x: (x['差距'], -x['勝率'], -x['天數']))
-                        
-                        st.session_state[KEY_RES] = final_results[:15]
+                    if final_results:
+                        st.session_state[KEY_RES] = final_results
                         st.session_state[KEY_BEST] = final_results[0]
                         st.success(f"掃描完成！最佳槓桿：{final_results[0]['槓桿']:.1f}x")
                     else: st.warning("無符合資料")
@@ -889,8 +2223,8 @@ with tabs[2]:
             with cB:
                 st.write("")
                 if st.button("➕ 加入", key="add_pf_v185"):
-                    exists = any(p['履約價'] == best['履約價'] and 
-                                 p['合約'] == best['合約'] for p in st.session_state[KEY_PF])
+                    exists = any(p['履約價'] == best['履約價'] and p['合約'] == best['合約'] and
+                                 p.get('類型', 'CALL') == best['類型'] for p in st.session_state[KEY_PF])
                     if not exists:
                         st.session_state[KEY_PF].append(best)
                         st.toast("✅ 已加入投組")
@@ -905,9 +2239,19 @@ with tabs[2]:
                 df_show['勝率'] = df_show['勝率'].map(lambda x: f"{x:.1f}%")
                 df_show['天數'] = df_show.get('天數', 0).astype(int)
                 
-                cols = ["合約", "履約價", "權利金", "槓桿", "勝率", "天數", "差距"]
+                cols = ["合約", "類型", "履約價", "權利金", "槓桿", "勝率", "天數", "差距"]
                 st.dataframe(df_show[cols], use_container_width=True, hide_index=True)
 
+            by_expiry = st.session_state[KEY_ALL]
+            if by_expiry is not None and not by_expiry.empty:
+                with st.expander("🗓️ 各到期最佳 (全鏈掃描)", expanded=False):
+                    st.dataframe(pd.DataFrame({
+                        "合約": by_expiry["contract_date"], "到期": by_expiry["expiry"].dt.strftime("%m/%d"),
+                        "類型": by_expiry["call_put"], "候選數": by_expiry["n"].astype(int),
+                        "履約價": by_expiry["strike_price"].astype(int), "權利金": by_expiry["price"].round(0).astype(int),
+                        "槓桿": by_expiry["leverage"].map(lambda x: f"{x:.1f}x"), "勝率": by_expiry["win"].map(lambda x: f"{x:.1f}%"),
+                        "差距": by_expiry["gap"].round(2)}), use_container_width=True, hide_index=True)
+
     with col_portfolio:
         st.markdown("#### 💼 **LEAPS CALL 投組**")
         if st.session_state[KEY_PF]:
@@ -918,6 +2262,15 @@ with tabs[2]:
             
             st.metric("總權利金", f"${int(total):,}")
             st.caption(f"{len(pf)}口 | Avg槓桿 {avg_lev:.1f}x | Avg勝率 {avg_win:.1f}%")
+
+            # 投組風險：greeks 加總 + 情境損益
+            pf_legs = portfolio_legs(st.session_state[KEY_PF], greeks, str(latest_date.date()))
+            pg = portfolio_greeks(pf_legs, S_current)
+            g1, g2 = st.columns(2)
+            g1.metric("Delta (元/點)", f"{pg['delta']:,.0f}")
+            g2.metric("Gamma", f"{pg['gamma']:,.2f}")
+            g1.metric("Vega (元/1%IV)", f"{pg['vega']:,.0f}")
+            g2.metric("Theta (元/日)", f"{pg['theta']:,.0f}")
             
             pf_s = pf.copy()
             pf_s['權利金'] = pf_s['價格'].round(0).astype(int)
@@ -936,8 +2289,74 @@ with tabs[2]:
             with c_dl:
                 st.download_button("📥 CSV匯出", pf.to_csv(index=False).encode('utf-8'), 
                                    "LEAPs_call_pf_v185.csv", key="dl_pf_v185")
+
+            with st.expander("📈 投組到期損益", expanded=False):
+                fig_pay, pay = plot_payoff(pf_legs, S_current, days_fwd=0, width_pct=0.2, title="投組損益 (實線到期 / 虛線今日理論)")
+                st.plotly_chart(fig_pay, use_container_width=True)
+                be_txt = " / ".join(f"{b:,.0f}" for b in pay["breakevens"]) or "無"
+                st.caption(f"最大獲利 **{fmt_pnl(pay['max_profit'])}** | 最大虧損 **{fmt_pnl(pay['max_loss'])}** | 損益兩平 {be_txt}")
+
+            with st.expander("🧮 情境損益 (指數 × IV × 天數)", expanded=False):
+                spot_pct = np.arange(-150, 151) / 1000              # 0.1% 一格，含 0
+                vol_shift = np.arange(-20, 31) / 200                # 0.5 vol 一格 (-10 ~ +15)，含 0
+                i_spot0, i_vol0 = 150, 20
+                max_days = max(int(pf_legs["T"].max() * TRADING_DAYS_PER_YEAR), 1)
+                days_fwd = np.unique(np.linspace(0, max_days, 30).round())
+                cube = scenario_grid(pf_legs, S_current, spot_pct, vol_shift, days_fwd)   # (301, 51, ≤30)
+                vol_opts = [float(v) for v in np.round(vol_shift * 100, 1)]
+                sel_vol = st.select_slider("IV 變動", options=vol_opts, value=vol_opts[i_vol0], key="pf_vol",
+                                           format_func=lambda v: f"{v:+.1f}%")
+                vi = vol_opts.index(sel_vol)
+                fig_sc = px.imshow(cube[:, vi, :].T / 10000, x=np.round(S_current * (1 + spot_pct)), y=days_fwd.astype(int),
+                                   color_continuous_scale="RdYlGn", color_continuous_midpoint=0, origin="lower", aspect="auto",
+                                   labels=dict(x="指數", y="經過交易日", color="損益(萬)"), height=320)
+                st.plotly_chart(fig_sc, use_container_width=True)
+                st.caption(f"今日損益 (IV 不變、指數 ±0)：{cube[i_spot0, i_vol0, 0]:,.0f} 元")
         else: st.info("💡 請先掃描並加入合約")
 
+    # 📜 規則回測：同一套選約規則 (方向 / 目標槓桿沿用上方設定) 在歷史 TXO 全鏈上重播
+    with st.expander("📜 **選約規則歷史回測** (歷史 TXO 全鏈逐日重播)", expanded=False):
+        b1, b2, b3, b4 = st.columns(4)
+        with b1: bt_every = st.number_input("每幾個交易日進場", 1, 60, 5, key="bt_every")
+        with b2: bt_tp = st.number_input("停利 %", 10, 1000, 100, 10, key="bt_tp")
+        with b3: bt_sl = st.number_input("停損 %", 10, 100, 50, 5, key="bt_sl")
+        with b4: bt_hold = st.number_input("最長持有 (交易日)", 5, 500, 120, key="bt_hold")
+        bt_mp = st.checkbox(f"多進程平行 (依合約月份分組，最多 {PARALLEL_MAX_WORKERS} 個進程)", False, key="bt_mp")
+        if st.button("▶️ 執行規則回測", key="bt_run"):
+            with st.spinner("載入歷史 TXO 並重播選約規則..."):
+                try:
+                    panel = get_txo_panel(FINMIND_TOKEN)
+                except:
+                    panel = pd.DataFrame()
+                if panel.empty:
+                    st.warning("⏳ 歷史 TXO 資料累積中")
+                else:
+                    data_key = f"{panel['date'].max():%Y-%m-%d}/{len(panel)}"
+                    trades, equity = get_leaps_backtest(data_key, op_type, target_lev, int(bt_every), bt_tp / 100,
+                                                        bt_sl / 100, int(bt_hold), bt_mp, panel)
+                    if trades.empty:
+                        st.warning("歷史資料中沒有符合規則的合約")
+                    else:
+                        dd = (equity.cummax() - equity).max()
+                        closed = trades[trades["原因"] != "未平倉"]
+                        n_open = len(trades) - len(closed)
+                        m1, m2, m3, m4 = st.columns(4)
+                        m1.metric("已出場筆數", f"{len(closed)}", f"未平倉 {n_open}", delta_color="off")
+                        m2.metric("勝率 (已出場)", f"{(closed['損益'] > 0).mean() * 100:.1f}%" if len(closed) else "—")
+                        m3.metric("累積損益 (含未實現)", f"${equity.iloc[-1]:,.0f}",
+                                  f"已出場平均報酬 {closed['報酬'].mean() * 100:+.1f}%" if len(closed) else None)
+                        m4.metric("最大回撤", f"${dd:,.0f}")
+                        fig_bt = go.Figure(go.Scatter(x=equity.index, y=equity.values, fill="tozeroy", line=dict(color="#FFA500")))
+                        fig_bt.update_layout(title=f"{op_type} 目標槓桿 {target_lev:.1f}x 累積損益 (元，每次 1 口)",
+                                             height=300, margin=dict(l=0,r=0,t=30,b=0))
+                        st.plotly_chart(fig_bt, use_container_width=True)
+                        st.dataframe(trades.assign(報酬=trades["報酬"].map(lambda x: f"{x*100:+.1f}%"),
+                                                   槓桿=trades["槓桿"].map(lambda x: f"{x:.1f}x")),
+                                     use_container_width=True, hide_index=True)
+                        st.caption(f"📅 {panel['date'].min():%Y-%m-%d} ~ {panel['date'].max():%Y-%m-%d} | "
+                                   "選約與進場價依掃描器 (同月同方向成交合約反推 IV 內插；有成交用收盤價，否則理論價)，持有期間以結算價評價；"
+                                   "「未平倉」為尚未到期也未觸發出場的部位，損益為最新結算價的未實現損益，不計入勝率")
+
     # ✅ LEAPS CALL 介紹區塊
     st.markdown("---")
     st.markdown("#### 📚 **LEAPS / LEAPS CALL 策略簡介**")
@@ -984,6 +2403,14 @@ with tabs[3]:
             init_capital = st.number_input("初始本金(萬)", 10, 500, 100)
         with col_p3: 
             leverage = st.slider("槓桿", 1, 5, 2)
+        col_mc1, col_mc2, col_mc3 = st.columns(3)
+        with col_mc1:
+            mc_paths = st.selectbox("蒙地卡羅路徑數", [10_000, 100_000, 300_000, 1_000_000], index=1,
+                                    format_func=lambda n: f"{n:,}")
+        with col_mc2:
+            mc_model = st.selectbox("報酬模型", ["區塊重抽 (實際報酬)", "常態分配"], index=0)
+        with col_mc3:
+            mc_parallel = st.checkbox(f"多進程平行 (最多 {PARALLEL_MAX_WORKERS} 個進程)", value=False)
         
         if st.button("🚀 執行回測", type="primary"):
             with st.spinner("計算中..."):
@@ -991,44 +2418,18 @@ with tabs[3]:
                 import plotly.graph_objects as go
                 import plotly.express as px
                 
-                dl = DataLoader()
-                dl.login_by_token(api_token=FINMIND_TOKEN)
-                
-                end_date = date.today().strftime("%Y-%m-%d")
-                start_date = (date.today() - timedelta(days=period_days + 100)).strftime("%Y-%m-%d")
-                df_hist = dl.taiwan_stock_daily("TAIEX", start_date, end_date)
+                df_hist = get_taiex_frame(FINMIND_TOKEN)
                 
                 if df_hist.empty:
                     st.error("❌ 無資料")
                 else:
-                    # 資料處理
-                    df_hist['close'] = df_hist['close'].astype(float)
-                    df_hist = df_hist[df_hist['Trading_Volume'] > 0].copy()
-                    df_hist['date'] = pd.to_datetime(df_hist['date'])
-                    df_hist = df_hist.sort_values('date').reset_index(drop=True)
-                    
-                    df_hist['MA20'] = df_hist['close'].rolling(20).mean()
-                    df_hist['MA60'] = df_hist['close'].rolling(60).mean()
-                    df_hist = df_hist.dropna().tail(period_days).reset_index(drop=True)
-                    
-                    # 策略
-                    df_hist['Signal'] = (df_hist['close'] > df_hist['MA20']) & (df_hist['MA20'] > df_hist['MA60'])
-                    df_hist['Daily_Ret'] = df_hist['close'].pct_change().fillna(0)
-                    df_hist['Strategy_Ret'] = df_hist['Signal'].shift(1).fillna(False) * df_hist['Daily_Ret'] * leverage
-                    
-                    # 資金曲線
-                    df_hist['Equity_Strategy'] = init_capital * (1 + df_hist['Strategy_Ret']).cumprod()
-                    df_hist['Equity_Benchmark'] = init_capital * (1 + df_hist['Daily_Ret']).cumprod()
-                    
-                    # KPI
-                    total_ret = (df_hist['Equity_Strategy'].iloc[-1] / init_capital - 1) * 100
-                    bench_ret = (df_hist['Equity_Benchmark'].iloc[-1] / init_capital - 1) * 100
-                    signal_days = df_hist['Signal'].shift(1) == True
-                    win_rate = (df_hist[signal_days & (df_hist['Strategy_Ret'] > 0)].shape[0] / signal_days.sum() * 100) if signal_days.sum() > 0 else 0
-                    
-                    df_hist['Equity_Peak'] = df_hist['Equity_Strategy'].cummax()
-                    mdd = ((df_hist['Equity_Peak'] - df_hist['Equity_Strategy']) / df_hist['Equity_Peak']).max() * 100
-                    sharpe = df_hist['Strategy_Ret'].mean() / df_hist['Strategy_Ret'].std() * np.sqrt(252) if df_hist['Strategy_Ret'].std() > 0 else 0
+                    # 回測結果依 (資料日期, 天數, 槓桿) 快取成單位本金，改本金只需縮放
+                    data_date = df_hist['date'].iloc[-1].strftime('%Y-%m-%d')
+                    bt_unit, kpi = get_ma_backtest(data_date, period_days, leverage, df_hist)
+                    df_hist = bt_unit.copy()
+                    for col in ['Equity_Strategy', 'Equity_Benchmark', 'Equity_Peak']:
+                        df_hist[col] = init_capital * df_hist[col]
+                    total_ret, bench_ret, win_rate, mdd, sharpe = (kpi[k] for k in ["total_ret", "bench_ret", "win_rate", "mdd", "sharpe"])
                     
                     # KPI展示
                     st.markdown("### 📊 **績效指標**")
@@ -1075,41 +2476,36 @@ with tabs[3]:
                     with col_mc:
                         st.markdown("### 🎲 **蒙地卡羅模擬**")
                         mu = df_hist['Strategy_Ret'].mean()
-                        sigma = df_hist['Strategy_Ret'].std()
-                        
                         sim_days = 252
-                        n_sims = 100  # 減少模擬次數提升穩定性
-                        np.random.seed(42)
                         
-                        # ✅ 正確維度：(n_sims, sim_days)
-                        sim_rets = np.random.normal(mu, sigma, (n_sims, sim_days))
-                        sim_paths = init_capital * np.cumprod(1 + sim_rets, axis=1)
+                        # 分塊 float32 模擬 + 串流分位數：路徑數再多記憶體也固定
+                        bands = get_mc_bands(data_date, period_days, leverage, mc_paths,
+                                             "bootstrap" if "重抽" in mc_model else "normal",
+                                             df_hist['Strategy_Ret'].to_numpy(), mc_parallel)
+                        current_equity = df_hist['Equity_Strategy'].iloc[-1]
                         
+                        # 扇形圖：5-95 / 25-75 兩層帶狀 + 中位數，圖檔大小與路徑數無關
+                        x_days = np.arange(1, sim_days + 1)
+                        fan = init_capital * bands
                         fig3 = go.Figure()
-                        # 只顯示前20條避免過密
-                        for i in range(min(20, n_sims)):
-                            fig3.add_trace(go.Scatter(
-                                x=list(range(sim_days)), 
-                                y=sim_paths[i, :].tolist(),  # ✅ 轉list防錯
-                                mode='lines',
-                                line=dict(width=1, color='lightblue'),
-                                showlegend=False,
-                                hovertemplate=''
-                            ))
+                        for lo_q, hi_q, color, label in [(5, 95, 'rgba(100,149,237,0.20)', '5%-95%'),
+                                                         (25, 75, 'rgba(100,149,237,0.45)', '25%-75%')]:
+                            fig3.add_trace(go.Scatter(x=x_days, y=fan[hi_q], mode='lines', line=dict(width=0),
+                                                      showlegend=False, hoverinfo='skip'))
+                            fig3.add_trace(go.Scatter(x=x_days, y=fan[lo_q], mode='lines', line=dict(width=0),
+                                                      fill='tonexty', fillcolor=color, name=label))
+                        fig3.add_trace(go.Scatter(x=x_days, y=fan[50], mode='lines', name='中位數',
+                                                  line=dict(width=2, color='royalblue')))
                         
                         # 當前資產水平線
-                        current_equity = df_hist['Equity_Strategy'].iloc[-1]
                         fig3.add_hline(y=current_equity, line_dash="dash", line_color="#00CC96",
                                      annotation_text=f"當前 {current_equity:.0f}萬")
                         
-                        fig3.update_layout(title=f"未來252天 (μ={mu*252:.1f}%)", height=350)
+                        fig3.update_layout(title=f"未來252天 (μ={mu*252:.1f}%，{mc_paths:,} 條路徑)", height=350)
                         st.plotly_chart(fig3, use_container_width=True)
                     
-                    # ✅ 修復分位數計算
-                    final_values = sim_paths[:, -1]  # 最後一天所有模擬結果
-                    p10 = np.percentile(final_values, 10)
-                    p50 = np.percentile(final_values, 50)
-                    p90 = np.percentile(final_values, 90)
+                    # 分位數由模擬引擎以直方圖串流累積，不需保留全部路徑
+                    p10, p50, p90 = (init_capital * bands[q].iloc[-1] for q in (10, 50, 90))
                     
                     col_m1, col_m2, col_m3 = st.columns(3)
                     col_m1.metric("🎯 中位數", f"{p50:.0f}萬")
@@ -1126,6 +2522,69 @@ with tabs[3]:
                     
                     st.caption("⚠️ 投資有風險 | 資料：FinMind TAIEX")
 
+        # 🔁 Walk-forward：訓練區挑參數、下一段測試，只看樣本外
+        with st.expander("🔁 **Walk-forward 樣本外驗證** (滾動訓練 → 測試)", expanded=False):
+            w1, w2 = st.columns(2)
+            with w1: wf_train = st.selectbox("訓練期", [500, 750, 1000], index=1, format_func=lambda d: f"{d} 交易日", key="wf_train")
+            with w2: wf_test = st.selectbox("測試期", [63, 126, 252], index=1, format_func=lambda d: f"{d} 交易日", key="wf_test")
+            if st.button("🔁 執行 Walk-forward", key="wf_run"):
+                df_wf = get_taiex_frame(FINMIND_TOKEN)
+                folds, oos = (pd.DataFrame(), pd.DataFrame()) if df_wf.empty else \
+                    get_walk_forward(df_wf['date'].iloc[-1].strftime('%Y-%m-%d'), wf_train, wf_test, leverage,
+                                     df_wf['date'].to_numpy(), df_wf['close'].to_numpy())
+                if folds.empty:
+                    st.warning("⏳ 歷史資料不足以切出訓練/測試區段")
+                else:
+                    eq_s = init_capital * (1 + oos['Strategy_Ret']).cumprod()
+                    eq_b = init_capital * (1 + oos['Daily_Ret']).cumprod()
+                    sd = oos['Strategy_Ret'].std()
+                    years = len(oos) / 252
+                    k1, k2, k3, k4 = st.columns(4)
+                    k1.metric("樣本外報酬", f"{(eq_s.iloc[-1] / init_capital - 1) * 100:+.1f}%",
+                              f"大盤 {(eq_b.iloc[-1] / init_capital - 1) * 100:+.1f}%")
+                    k2.metric("年化報酬", f"{((eq_s.iloc[-1] / init_capital) ** (1 / years) - 1) * 100:+.1f}%")
+                    k3.metric("樣本外 Sharpe", f"{oos['Strategy_Ret'].mean() / sd * np.sqrt(252) if sd > 0 else 0:.2f}")
+                    k4.metric("最大回撤", f"{((eq_s.cummax() - eq_s) / eq_s.cummax()).max() * 100:.1f}%")
+                    fig_wf = go.Figure()
+                    fig_wf.add_trace(go.Scatter(x=oos['date'], y=eq_s, name='樣本外策略', line=dict(color='#00CC96', width=2)))
+                    fig_wf.add_trace(go.Scatter(x=oos['date'], y=eq_b, name='大盤', line=dict(color='#EF553B', dash='dash')))
+                    for d in folds['測試起']:
+                        fig_wf.add_vline(x=d, line_width=1, line_color="gray", opacity=0.3)
+                    fig_wf.update_layout(title=f"串接樣本外資金曲線 ({len(folds)} 段，槓桿 {leverage}x)", height=330, hovermode="x unified")
+                    st.plotly_chart(fig_wf, use_container_width=True)
+                    st.dataframe(folds.assign(測試起=folds['測試起'].dt.strftime('%Y-%m-%d'), 測試迄=folds['測試迄'].dt.strftime('%Y-%m-%d'))
+                                 .round(2), use_container_width=True, hide_index=True)
+                    st.caption(f"💡 每段只用當時以前的資料挑快/慢線，槓桿固定為上方設定的 {leverage}x；訓練 Sharpe 遠高於測試 Sharpe 代表過度擬合")
+
+        # 🧪 參數掃描：快/慢均線 × 槓桿 全組合一次算完
+        with st.expander("🧪 **均線參數掃描** (快線 × 慢線 × 槓桿)", expanded=False):
+            s1, s2, s3 = st.columns(3)
+            with s1: fast_rng = st.slider("快線範圍", 5, 60, (5, 40), 5, key="sw_fast")
+            with s2: slow_rng = st.slider("慢線範圍", 20, 240, (40, 200), 10, key="sw_slow")
+            with s3: sw_metric = st.selectbox("熱力圖指標", ["Sharpe", "報酬率 %", "最大回撤 %"], key="sw_metric")
+            if st.button("🧪 執行掃描", key="sw_run"):
+                df_sw = get_taiex_frame(FINMIND_TOKEN)
+                if df_sw.empty:
+                    st.error("❌ 無資料")
+                else:
+                    fast_w = list(range(fast_rng[0], fast_rng[1] + 1, 5))
+                    slow_w = list(range(slow_rng[0], slow_rng[1] + 1, 10))
+                    levs = [1, 2, 3, 4, 5]
+                    res = ma_sweep(df_sw["close"].to_numpy(), fast_w, slow_w, levs, period_days)
+                    key = {"Sharpe": "sharpe", "報酬率 %": "ret", "最大回撤 %": "mdd"}[sw_metric]
+                    li = levs.index(leverage)
+                    grid = pd.DataFrame(res[key][:, :, li], index=[f"MA{w}" for w in fast_w], columns=[f"MA{w}" for w in slow_w])
+                    fig_sw = px.imshow(grid, color_continuous_scale="RdYlGn_r" if key == "mdd" else "RdYlGn",
+                                       labels=dict(x="慢線", y="快線", color=sw_metric), aspect="auto", height=400,
+                                       title=f"{sw_metric} (槓桿 {leverage}x，近 {period_days} 日)")
+                    st.plotly_chart(fig_sw, use_container_width=True)
+                    # Sharpe 不隨槓桿變，只在目前槓桿的切面上挑快/慢線
+                    bi, bj = np.unravel_index(np.nanargmax(res["sharpe"][:, :, li]), res["sharpe"].shape[:2])
+                    best = (bi, bj, li)
+                    st.caption(f"🏆 最佳 Sharpe：MA{fast_w[bi]} / MA{slow_w[bj]} (槓桿 {leverage}x) → "
+                               f"Sharpe {res['sharpe'][best]:.2f} | 報酬 {res['ret'][best]:+.1f}% | 回撤 {res['mdd'][best]:.1f}% "
+                               f"(共 {np.isfinite(res['sharpe'][:, :, li]).sum()} 組均線)")
+
 
 # --------------------------
 # Tab 4: 專業戰情室 (全功能整合版)
@@ -1300,8 +2759,26 @@ with tabs[4]:
 
     with col_chip1:
         st.markdown("#### 💰 **籌碼戰場 (OI Walls)**")
-        st.plotly_chart(plot_oi_walls(S_current), use_container_width=True)
-        st.caption("💡 紅色為大量 Call 賣壓 (壓力)，青色為大量 Put 支撐")
+        oi_walls, oi_summary = get_oi_walls(str(latest_date.date()), df_latest)
+        if not oi_summary.empty:
+            oi_con = st.selectbox("到期合約", list(oi_summary.index), 0, key="oi_con",
+                                  format_func=lambda c: f"{c} ({oi_summary.at[c, 'expiry']:%m/%d})")
+            st.plotly_chart(plot_oi_walls(S_current, oi_walls, oi_con, oi_summary), use_container_width=True)
+            row = oi_summary.loc[oi_con]
+            st.caption(f"💡 紅色為 Call 未平倉 (壓力)，青色為 Put 未平倉 (支撐) | 最大痛點 **{row['max_pain']:,.0f}** | "
+                       f"Call 牆 {row['call_wall']:,.0f} | Put 牆 {row['put_wall']:,.0f} | P/C Ratio {row['pcr']:.2f}")
+        else:
+            st.info("⚠️ 暫無未平倉資料")
+
+        st.markdown("#### 🧲 **Gamma 曝險 (GEX)**")
+        gex_strike, gex_profile, gex_flip = get_gex_profile(str(latest_date.date()), S_current, df_latest)
+        if not gex_profile.empty:
+            st.plotly_chart(plot_gex(S_current, gex_strike, gex_profile, gex_flip), use_container_width=True)
+            regime = "正 Gamma (波動收斂)" if gex_profile["gex"].iloc[len(gex_profile) // 2] >= 0 else "負 Gamma (波動放大)"
+            flip_txt = f"{gex_flip:,.0f}" if np.isfinite(gex_flip) else "區間內無翻轉"
+            st.caption(f"💡 目前處於 **{regime}** | 零 Gamma 翻轉點 **{flip_txt}**")
+        else:
+            st.info("⚠️ 暫無未平倉資料，無法計算 GEX")
 
         st.markdown("#### 🏦 **三大法人動向**")
         with st.spinner("載入法人資料..."):
@@ -1321,9 +2798,25 @@ with tabs[4]:
 
     with col_chip2:
         st.markdown("#### 📉 **即時損益試算**")
-        k_sim = st.number_input("模擬履約價", 15000, 50000, int(S_current))
-        p_sim = st.number_input("權利金", 1, 1000, 150)
-        st.plotly_chart(plot_payoff(k_sim, p_sim, "CALL"), use_container_width=True)
+        sim_default = pd.DataFrame([{"類型": "CALL", "買賣": "買進", "履約價": int(round(S_current / 100) * 100), "權利金": 150, "口數": 1}])
+        sim_df = st.data_editor(sim_default, num_rows="dynamic", hide_index=True, use_container_width=True, key="sim_legs",
+                                column_config={"類型": st.column_config.SelectboxColumn(options=["CALL", "PUT"], required=True),
+                                               "買賣": st.column_config.SelectboxColumn(options=["買進", "賣出"], required=True),
+                                               "履約價": st.column_config.NumberColumn(min_value=1000, max_value=50000, step=50),
+                                               "權利金": st.column_config.NumberColumn(min_value=0.0, max_value=5000.0),
+                                               "口數": st.column_config.NumberColumn(min_value=1, max_value=100, step=1)})
+        sim_df = sim_df.dropna(subset=["類型", "買賣", "履約價", "權利金"])
+        s1, s2 = st.columns(2)
+        with s1: sim_days = st.number_input("剩餘交易日", 1, 250, 20, key="sim_days")
+        with s2: sim_iv = st.number_input("IV %", 5.0, 100.0, 20.0, key="sim_iv")
+        sim_legs = pd.DataFrame({"K": sim_df["履約價"].astype(float), "is_call": sim_df["類型"] == "CALL",
+                                 "qty": np.where(sim_df["買賣"] == "買進", 1.0, -1.0) * sim_df["口數"].fillna(1).astype(float),
+                                 "premium": sim_df["權利金"].astype(float), "iv": sim_iv / 100, "T": sim_days / TRADING_DAYS_PER_YEAR})
+        if not sim_legs.empty:
+            fig_pay, pay = plot_payoff(sim_legs, S_current, days_fwd=0, title=f"損益圖 ({len(sim_legs)} 腿)")
+            st.plotly_chart(fig_pay, use_container_width=True)
+            be_txt = " / ".join(f"{b:,.0f}" for b in pay["breakevens"]) or "無"
+            st.caption(f"最大獲利 **{fmt_pnl(pay['max_profit'])}** | 最大虧損 **{fmt_pnl(pay['max_loss'])}** | 損益兩平 {be_txt}")
         
         st.markdown("#### 🔑 **關鍵點位**")
         with st.spinner("計算支撐壓力..."):
@@ -1335,6 +2828,62 @@ with tabs[4]:
         else:
             st.warning("⚠️ K 線資料連線中斷")
 
+        st.markdown("#### 🌡️ **波動率溫度計**")
+        try:
+            iv_daily, iv_term = get_iv_history(FINMIND_TOKEN)
+        except:
+            iv_daily, iv_term = pd.DataFrame(), pd.DataFrame()
+        iv_now = iv_regime(iv_daily)
+        if iv_now:
+            v1, v2, v3 = st.columns(3)
+            v1.metric("ATM IV", f"{iv_now['iv']*100:.1f}%", iv_now["label"], delta_color="off")
+            v2.metric("IV Rank", f"{iv_now['rank']:.0f}")
+            v3.metric("IV 百分位", f"{iv_now['pct']:.0f}%")
+            fig_iv = go.Figure(go.Scatter(x=iv_daily["date"], y=iv_daily["atm_iv"] * 100, line=dict(color="#FFA500")))
+            fig_iv.update_layout(title="一個月 ATM IV (%)", height=200, margin=dict(l=0,r=0,t=30,b=0))
+            st.plotly_chart(fig_iv, use_container_width=True)
+            last_term = iv_term[iv_term["date"] == iv_term["date"].max()].sort_values("T")
+            fig_ts = go.Figure(go.Scatter(x=last_term["contract_date"], y=last_term["atm_iv"] * 100, mode="lines+markers"))
+            fig_ts.update_layout(title="期限結構 (各到期 ATM IV %)", height=200, margin=dict(l=0,r=0,t=30,b=0))
+            st.plotly_chart(fig_ts, use_container_width=True)
+            st.caption(f"💡 IV 百分位 < 30% 買方較划算，> 70% 權利金偏貴 (歷史樣本 {len(iv_daily)} 日，持續回補中)")
+        else:
+            st.info("⏳ 歷史 IV 資料累積中")
+
+    st.markdown("#### 🧾 **價差篩選 (Credit Spread 收租 / 日曆價差)**")
+    sp_greeks = get_greeks_table(str(latest_date.date()), S_current, df_latest)
+    sp_names = {"bear_call": "空頭 Call 價差 (收租)", "bull_put": "多頭 Put 價差 (收租)",
+                "bull_call": "多頭 Call 價差 (付費)", "bear_put": "空頭 Put 價差 (付費)", "calendar": "日曆價差 (賣近買遠)"}
+    f1, f2, f3, f4 = st.columns(4)
+    with f1: sp_kind = st.selectbox("策略", list(sp_names), 0, key="sp_kind", format_func=sp_names.get)
+    with f2: sp_width = st.number_input("最大寬度 (點)", 50, 3000, 500, 50, key="sp_width")
+    with f3: sp_pop = st.slider("最低獲利機率 %", 30, 95, 60, 5, key="sp_pop")
+    with f4: sp_k = st.number_input("顯示筆數", 5, 100, 15, 5, key="sp_k")
+    if sp_kind == "calendar":
+        sp_cp = st.radio("方向", ["CALL", "PUT"], horizontal=True, key="sp_cp")
+        sp_res = calendar_spreads(sp_greeks, S_current, sp_cp, width_pct=sp_width / S_current, top_k=int(sp_k))
+        if sp_res.empty:
+            st.info("⚠️ 無符合條件的日曆價差")
+        else:
+            sp_show = sp_res.rename(columns={"short_con": "賣出月份", "long_con": "買進月份", "strike": "履約價", "debit": "付出(點)",
+                                             "net_theta": "淨Theta(元/日)", "iv_ratio": "近/遠 IV", "score": "Theta/成本"})
+            st.dataframe(sp_show.round({"付出(點)": 1, "淨Theta(元/日)": 0, "近/遠 IV": 2, "Theta/成本": 4}),
+                         use_container_width=True, hide_index=True)
+            st.caption(f"💡 履約價限現價 ±{sp_width} 點；近/遠 IV > 1 代表賣出的近月權利金相對較貴")
+    else:
+        sp_res = vertical_spreads(sp_greeks, S_current, sp_kind, max_width=sp_width, min_pop=sp_pop / 100, top_k=int(sp_k))
+        if sp_res.empty:
+            st.info("⚠️ 無符合條件的價差組合")
+        else:
+            sp_show = pd.DataFrame({"月份": sp_res["contract_date"], "天數": sp_res["days"].astype(int),
+                                    "賣出": sp_res["short_K"].astype(int), "買進": sp_res["long_K"].astype(int),
+                                    "收/付(點)": sp_res["net"].round(1), "寬度": sp_res["width"].astype(int),
+                                    "最大獲利": sp_res["max_profit"].round(0).astype(int), "最大虧損": sp_res["max_loss"].round(0).astype(int),
+                                    "報酬/風險": sp_res["ror"].map(lambda x: f"{x:.2f}"), "獲利機率": sp_res["pop"].map(lambda x: f"{x:.0%}"),
+                                    "賣腿OTM": sp_res["short_otm"].map(lambda x: f"{x:.0%}")})
+            st.dataframe(sp_show, use_container_width=True, hide_index=True)
+            st.caption("💡 獲利機率以損益兩平點與兩腿平均 IV 推算 N(d2)，賣腿 OTM 以 1-|Delta| 估計；排序 = 獲利機率 × 報酬/風險")
+
     st.markdown("#### 💼 **我的投組**")
     if st.button("➕ 加入虛擬倉位"):
         st.session_state.portfolio.append({"K": 23000, "P": 180, "Date": str(date.today())})
@@ -1410,8 +2959,7 @@ with tabs[5]:
                         out.append([sid, ETF_META[sid]['name'], price, chg, source])
                     else:
                         # 備用：FinMind 最近日
-                        from FinMind.data import DataLoader
-                        dl = DataLoader()
+                        dl = get_finmind(FINMIND_TOKEN)
                         f_df = dl.taiwan_stock_daily(sid, (_today_tw()-timedelta(days=5)).strftime('%Y-%m-%d'))
                         if len(f_df) > 0:
                             last = f_df.iloc[-1]
@@ -1664,6 +3212,7 @@ with tabs[0]:
         "t5_price_snapshot": {}, # NEW
         "t5_revenue_segments": [],      # 🔥 新增
         "t5_product_info": "",          # 🔥 新增
+        "t5_job": None,                 # 最近一次研究任務結果
     }
     for k, v in defaults.items():
         if k not in st.session_state:
@@ -1697,7 +3246,20 @@ with tabs[0]:
 
     c1, c2, c3 = st.columns([1.5, 1, 1.5])
     with c1:
-        stock_code = st.text_input("🏭 代碼 (個股/ETF)", value="0050", max_chars=6)
+        if "t5_code" not in st.session_state:
+            st.session_state["t5_code"] = "0050"
+        stock_code = st.text_input("🏭 代碼 (個股/ETF)", max_chars=6, key="t5_code")
+        # type-ahead：本地主檔索引，輸入時不打網路
+        master = get_security_master(FINMIND_TOKEN)
+        if stock_code and master.lookup(stock_code) is None:
+            hints = master.suggest(stock_code)
+            if hints:
+                def _apply_code_hint():
+                    pick = st.session_state.get("t5_code_hint")
+                    if pick: st.session_state["t5_code"] = pick.split(" ")[0]
+                st.selectbox("💡 你要找的是？", [""] + [f"{sid} {name}" for sid, name in hints],
+                             key="t5_code_hint", on_change=_apply_code_hint)
+        stock_code = master.resolve(stock_code)
     with c2:
         days_period = st.selectbox("⏳ 觀察期", [7, 14, 30, 90], index=1)
     with c3:
@@ -1753,72 +3315,73 @@ with tabs[0]:
             return None
 
     # =========================================================
-    # 3) Core run
+    # 3) Core run：研究流程只在按下按鈕時執行；結果依 (代碼, 觀察期, 權重, 交易日) 快取
     # =========================================================
-    if run_btn:
-        prog = st.progress(0)
-        status = st.empty()
-        # =======================================================
-        # 【統一安全宣告區】確保所有變數有初始值，不管 API 成功與否
-        # =======================================================
-        import yfinance as yf
-        import pandas as pd
-        import time
-        import random
-        import textwrap
-        import feedparser
-        from datetime import datetime, timedelta
-
-        # 所有變數強制初始化，避免任何 NameError
-        stock_name       = ""
-        industry         = "未知產業"
-        is_etf           = False
-        dl               = None
-        hist             = pd.DataFrame()
-        S_current        = 0.0
-        ma20             = 0.0
-        valuation        = {}
-        price_snapshot   = {}
-        dividend_metrics = {}
-        dividend_history = []   # ← 加這行！
-        advanced_data    = {
-            "revenue_yoy":      "無資料",
-            "foreign_inv":      "無資料",
-            "investment_trust": "無資料"
-        }
+    def render_research_job(job):
+        for kind, msg in job["notes"]:
+            getattr(st, kind)(msg)
+        if job["report"]:
+            # 單篇報告展示（改進版）
+            clean_report = clean_md(job["report"])
+            st.markdown("## 🏦 **綜合研究報告（三方融合）**")
+            st.markdown(clean_report)
+            st.download_button("📥 下載綜合報告", clean_report, f"{job['stock_code']}_綜合報告.md")
+
+        # C6. 儀表板（100%保留）
+        adv, snap = job["advanced_data"], job["price_snapshot"]
+        # 🔥 新增：產品營收組成儀表板
+        if adv.get("revenue_segments"):
+            st.markdown("#### 🧩 **產品營收組成**")
+            segments = adv.get("revenue_segments", [])
+
+            if isinstance(segments, list) and segments:
+                seg_cols = st.columns(min(3, len(segments)))
+                for i, seg in enumerate(segments[:3]):
+                    with seg_cols[i]:
+                        rev = safe_num(seg.get('revenue', 0), 0)
+                        st.metric(
+                            f"**{seg.get('segment_name', 'N/A')}**",
+                            f"{rev:,.0f}萬" if rev else "—"
+                        )
+                st.caption(f"前三大占比：{adv.get('top3_concentration', 'N/A')}")
+            else:
+                st.caption(adv.get("key_products", "查詢中..."))
+
+            st.divider()
+
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("💰 現價", f"{snap.get('last_price') or 0:,.0f}元")
+        col2.metric("📈 乖離", f"{adv.get('ma20_deviation', '0%')}")
+        col3.metric("🏦 年配", f"{job['dividend_metrics'].get('avg_div') or 0:.2f}元")
+        col4.metric("📊 P/E", f"{job['valuation'].get('trailingPE', 'N/A')}")
+
+        st.success("✅ Step C 綜合報告生成完成！")
+        if job.get("cached"):
+            st.caption(f"⚡ 快取結果（{job['generated_at']} 產生）")
+
+    research_key = (stock_code, days_period, focus_region, str(latest_date.date()))
+    research_cache = get_research_cache()
+    cached_job = research_cache.get(research_key) if run_btn else None
+    if cached_job is not None:
+        st.session_state.update(cached_job["state"])
+        st.session_state["t5_job"] = dict(cached_job, cached=True)
+
+    if not run_btn or cached_job is not None:
+        # 沒按按鈕 (其他元件互動、autorefresh) 或命中快取：只顯示結果，不碰任何上游
+        if st.session_state.get("t5_job"):
+            render_research_job(st.session_state["t5_job"])
+        st.stop()
+
+    prog = st.progress(0)
+    research_notes = []   # 執行期間的提示訊息，連同結果一起快取
+
 # =======================================================
 # Step A: 雙引擎辨識標的與進階數據抓取（完整保留版）
 # =======================================================
 
-# status 防呆（保留）
-try:
-    from status import status
-    prog = status
-except ImportError:
-    class DummyStatus:
-        def info(self, msg): pass  # ← 改成 pass（靜默）
-        def success(self, msg): pass  # ← 改成 pass（靜默）
-        def warning(self, msg): pass  # ← 改成 pass（靜默）
-        def progress(self, val): 
-            if 'prog' not in st.session_state: 
-                st.session_state.prog = st.progress(0)
-            st.session_state.prog.progress(val)
-    status = DummyStatus()
-    prog = status
-
-# status.info(f"🔍 雙引擎...")  # ← 註解（靜默）
-
-# **A0. 本地保險字典（完整保留）**
-local_industry_map = {
-    "2330": ("台積電",    "半導體業"), "2454": ("聯發科",    "半導體業"),
-    "2317": ("鴻海",      "電子業"),   "2303": ("聯電",      "半導體業"),
-    "2603": ("長榮",      "航運業"),   "2609": ("陽明",      "航運業"),
-    "2610": ("華航",      "航空業"),   "2618": ("長榮航",    "航空業"),
-    "2608": ("嘉里大榮",  "陸運業"),   "6214": ("精誠",      "資訊服務業"),
-    "2881": ("富邦金",    "金融保險業"),"2344": ("華邦電",    "記憶體"),
-    "1264": ("德麥",      "食品工業"), "0050": ("元大台灣50", "ETF"),
-    "0056": ("元大高股息","ETF"),
-}
+# **A0. 證券主檔 (本地索引，不需網路)**
+security_master = get_security_master(finmind_key)
+stock_code = security_master.resolve(stock_code)
 
 stock_name = stock_code
 industry = "未知產業"
@@ -1829,35 +3392,15 @@ price_snapshot = {}
 dividend_metrics = {}
 valuation = {}
 
-if stock_code in local_industry_map:
-    stock_name, industry = local_industry_map[stock_code]
-    is_etf = industry == "ETF"
-    prog.progress(10)
+hit = security_master.lookup(stock_code)
+if hit:
+    stock_name, industry = hit
+    is_etf = security_master.is_etf(stock_code)
+prog.progress(10)
 
-# **A1. FinMind 雙引擎（完整保留）**
-finmind_key = st.secrets.get("FINMIND_TOKEN", st.secrets.get("finmind_token", ""))
-dl = None
-try:
-    from FinMind.data import DataLoader
-    dl = DataLoader()
-    if finmind_key:
-        dl.login_by_token(api_token=finmind_key)
-    
-    df_info = dl.taiwan_stock_info()
-    row = df_info[df_info["stock_id"] == stock_code]
-    if not row.empty:
-        stock_name = str(row["stock_name"].iloc[0])
-        industry = str(row["industry_category"].iloc[0])
-        etf_kw = ["ETF", "指數股票型", "基金", "債券", "期信", "etf"]
-        is_etf = (
-            is_etf or stock_code.startswith("0")
-            or any(k.lower() in (industry + stock_name).lower() for k in etf_kw)
-        )
-    prog.progress(30)
-except Exception as e:
-    pass  # 靜默
+# **A1~A3. 多源並行抓取：FinMind + yfinance 同時出發，各自逾時，先回來先合併**
+dl = get_finmind(finmind_key)
 
-# **A2. yfinance（完整保留）**
 def safe_num(val, rd=2):
     try: return round(float(val), rd) if pd.notna(val) else None
     except: return None
@@ -1866,132 +3409,116 @@ def safe_int(val):
     try: return int(val) if pd.notna(val) else None
     except: return None
 
-try:
-    import yfinance as yf
-    yf_ticker = yf.Ticker(f"{stock_code}.TW")
-    hist = yf_ticker.history(period="5y", auto_adjust=False)
-    
-    if hist.empty:
-        yf_ticker = yf.Ticker(f"{stock_code}.TWO")
-        hist = yf_ticker.history(period="5y", auto_adjust=False)
-    
-    if not hist.empty:
-        hist.index = hist.index.tz_localize(None)
-        close = hist["Close"].dropna()
-        
+STEP_A_TIMEOUTS = {
+    "history": 20, "yf_info": 12, "dividends": 12,
+    "revenue": 12, "institutional": 12, "segment": 12, "financials": 15, "etf_composition": 12,
+}
+
+def _yf_first(code, getter, is_empty):
+    """上市 (.TW) 查不到再試上櫃 (.TWO)。"""
+    val = None
+    for sym in (f"{code}.TW", f"{code}.TWO"):
+        val = getter(yf.Ticker(sym))
+        if not is_empty(val): return val
+    return val
+
+def _ymd(days_ago):
+    return (datetime.today() - timedelta(days_ago)).strftime("%Y%m%d")
+
+step_a_tasks = {
+    "history": lambda: _yf_first(stock_code, lambda t: t.history(period="5y", auto_adjust=False), lambda h: h.empty),
+    "yf_info": lambda: _yf_first(stock_code, lambda t: t.info or {},
+                                 lambda i: not (i.get("marketCap") or i.get("trailingPE") or i.get("priceToBook"))),
+    "dividends": lambda: _yf_first(stock_code, lambda t: t.dividends, lambda d: d.empty),
+    "revenue": lambda: dl.taiwan_stock_month_revenue(stock_id=stock_code, start_date=_ymd(90)),
+    "institutional": lambda: dl.taiwan_stock_institutional_investors(stock_id=stock_code, start_date=_ymd(15)),
+    "segment": lambda: dl.taiwan_stock_segment(stock_id=stock_code, start_date=_ymd(365)),
+    "financials": lambda: dl.financial_statement(stock_id=stock_code, start_date=_ymd(365)),
+}
+etf_comp_df = None
+if is_etf or stock_code.startswith("0"):
+    # 疑似 ETF 就先把成分股一起抓，Step C 直接取用
+    step_a_tasks["etf_composition"] = lambda: dl.taiwan_etf_composition(stock_id=stock_code)
+
+df_fund = pd.DataFrame()
+
+def merge_step_a(name, res):
+    global etf_comp_df, df_fund
+    if name == "history" and not res.empty:
+        res.index = res.index.tz_localize(None)
+        close = res["Close"].dropna()
         if len(close) >= 20:
             last_px = float(close.iloc[-1])
             ma20 = close.tail(20).mean()
             deviation = (last_px - ma20) / ma20 * 100
-            price_snapshot = {
+            price_snapshot.update({
                 "last_price": safe_num(last_px, 2),
                 "deviation_ma20_pct": safe_num(deviation, 2),
                 "hist_points": int(len(close))
-            }
+            })
             advanced_data["ma20_deviation"] = f"{deviation:.2f}%"
-        
-        info = yf_ticker.info or {}
-        valuation = {
-            "trailingPE": safe_num(info.get("trailingPE")),
-            "priceToBook": safe_num(info.get("priceToBook")),
-            "marketCap": safe_int(info.get("marketCap"))
-        }
-        
-        divs = yf_ticker.dividends
-        if not divs.empty:
-            divs.index = divs.index.tz_localize(None)
-            recent_divs = divs.tail(4)
-            dividend_metrics["avg_div"] = safe_num(recent_divs.mean())
-    
-    prog.progress(60)
-except Exception as e:
-    pass
-
-# **A3. FinMind 進階數據（完整保留）**
-if dl:
-    try:
-        prog.progress(70)
-        
+    elif name == "yf_info" and res:
+        valuation.update({
+            "trailingPE": safe_num(res.get("trailingPE")),
+            "priceToBook": safe_num(res.get("priceToBook")),
+            "marketCap": safe_int(res.get("marketCap"))
+        })
+    elif name == "dividends" and not res.empty:
+        res.index = res.index.tz_localize(None)
+        dividend_metrics["avg_div"] = safe_num(res.tail(4).mean())
+    elif name == "revenue" and not res.empty:
         # 1. 營收 YoY
-        df_rev = dl.taiwan_stock_month_revenue(
-            stock_id=stock_code,
-            start_date=(datetime.today() - timedelta(90)).strftime("%Y%m%d")
-        )
-        if not df_rev.empty:
-            yoy = df_rev['revenue_YearOnYear_ratio'].dropna()
-            if len(yoy) > 0:
-                advanced_data["revenue_yoy"] = f"{yoy.iloc[-1]:.1f}% (最新月)"
-        
-        prog.progress(80)
-        
+        yoy = res['revenue_YearOnYear_ratio'].dropna()
+        if len(yoy) > 0:
+            advanced_data["revenue_yoy"] = f"{yoy.iloc[-1]:.1f}% (最新月)"
+    elif name == "institutional" and not res.empty:
         # 2. 外資籌碼
-        df_inst = dl.taiwan_stock_institutional_investors(
-            stock_id=stock_code,
-            start_date=(datetime.today() - timedelta(15)).strftime("%Y%m%d")
-        )
-        if not df_inst.empty:
-            foreign_data = df_inst[df_inst['type'] == 'foreign_investor()']
-            if not foreign_data.empty:
-                foreign_net = foreign_data['change_from_previous_day'].sum()
-                advanced_data["foreign_chips"] = f"外資近15天{foreign_net:+.0f}張"
-        
-        prog.progress(85)
-                # 4. 🔥 新增：產品營收組成 + 主要產品線
-        try:
-            prog.progress(90)
-            
-            # 產品營收組成（FinMind）
-            df_segment = dl.taiwan_stock_segment(
-                stock_id=stock_code,
-                start_date=(datetime.today() - timedelta(365)).strftime("%Y%m%d")
-            )
-            if not df_segment.empty:
-                latest_segment = df_segment.tail(1)
-                segment_info = latest_segment[['segment_name', 'revenue']].to_dict('records')
-                advanced_data["revenue_segments"] = segment_info[:3]  # 前3大產品線
-                
-                # 計算前三大占比
-                total_rev = latest_segment['revenue'].sum()
-                if total_rev > 0:
-                    top3_pct = sum([s['revenue'] for s in segment_info[:3]]) / total_rev * 100
-                    advanced_data["top3_concentration"] = f"{top3_pct:.1f}%"
-            
-            # 備用：個股專屬產品字典（半導體/航運等）
-            product_catalog = {
-
-            }
-            if stock_code in product_catalog:
-                advanced_data["key_products"] = product_catalog[stock_code]
-                
-        except Exception as e:
-            advanced_data["revenue_segments"] = "分部資料暫缺"
-            pass
-
-        
-        # 3. P/E + EPS
-        df_fund = dl.financial_statement(
-            stock_id=stock_code,
-            start_date=(datetime.today() - timedelta(365)).strftime("%Y%m%d")
-        )
-        eps_rows = df_fund[df_fund['FinancialStatementType'] == 'EPS']
-        if not eps_rows.empty:
-            eps_latest = float(eps_rows['Value'].tail(1).iloc[0])
-            last_price = price_snapshot.get('last_price', 0)
-            if last_price > 0 and eps_latest != 0:
-                pe_calc = last_price / abs(eps_latest)
-                valuation["calculatedPE"] = round(pe_calc, 2)
-                valuation["EPS"] = round(eps_latest, 2)
-                advanced_data["PE_EPS"] = f"P/E:{pe_calc:.1f}x"
-        
-        gross_margin_rows = df_fund[df_fund['FinancialStatementType'] == 'GrossMargin']
-        if not gross_margin_rows.empty:
-            gm_latest = float(gross_margin_rows['Value'].tail(1).iloc[0])
-            advanced_data["gross_margin"] = f"{gm_latest:.1f}%"
-        
-        prog.progress(100)
-        
-    except Exception as e:
-        pass
+        foreign_data = res[res['type'] == 'foreign_investor()']
+        if not foreign_data.empty:
+            foreign_net = foreign_data['change_from_previous_day'].sum()
+            advanced_data["foreign_chips"] = f"外資近15天{foreign_net:+.0f}張"
+    elif name == "segment" and not res.empty:
+        # 4. 產品營收組成 + 前三大占比
+        latest_segment = res.tail(1)
+        segment_info = latest_segment[['segment_name', 'revenue']].to_dict('records')
+        advanced_data["revenue_segments"] = segment_info[:3]
+        total_rev = latest_segment['revenue'].sum()
+        if total_rev > 0:
+            top3_pct = sum([s['revenue'] for s in segment_info[:3]]) / total_rev * 100
+            advanced_data["top3_concentration"] = f"{top3_pct:.1f}%"
+    elif name == "financials":
+        df_fund = res   # P/E 需要股價，等全部來源回來再算
+    elif name == "etf_composition":
+        etf_comp_df = res
+
+step_a_done = [0]
+def on_step_a_result(name, res):
+    merge_step_a(name, res)
+    step_a_done[0] += 1
+    prog.progress(min(10 + int(90 * step_a_done[0] / len(step_a_tasks)), 100))
+
+step_a_ok = run_concurrent(step_a_tasks, STEP_A_TIMEOUTS, on_step_a_result, max_workers=6)
+if "segment" not in step_a_ok:
+    advanced_data["revenue_segments"] = "分部資料暫缺"
+
+# 3. P/E + EPS（需要 history 的最新價）
+try:
+    eps_rows = df_fund[df_fund['FinancialStatementType'] == 'EPS']
+    if not eps_rows.empty:
+        eps_latest = float(eps_rows['Value'].tail(1).iloc[0])
+        last_price = price_snapshot.get('last_price', 0) or 0
+        if last_price > 0 and eps_latest != 0:
+            pe_calc = last_price / abs(eps_latest)
+            valuation["calculatedPE"] = round(pe_calc, 2)
+            valuation["EPS"] = round(eps_latest, 2)
+            advanced_data["PE_EPS"] = f"P/E:{pe_calc:.1f}x"
+    gross_margin_rows = df_fund[df_fund['FinancialStatementType'] == 'GrossMargin']
+    if not gross_margin_rows.empty:
+        gm_latest = float(gross_margin_rows['Value'].tail(1).iloc[0])
+        advanced_data["gross_margin"] = f"{gm_latest:.1f}%"
+except Exception:
+    pass
+prog.progress(100)
 
 # **儲存結果**
 st.session_state.update({
@@ -2001,7 +3528,7 @@ st.session_state.update({
 })
 
 # ✅ 完美結束（唯一一行顯示）
-st.success(f"✅ {stock_name} 資料收集完成")
+research_notes.append(("success", f"✅ {stock_name} 資料收集完成"))
 
 # =======================================================
 # Step B+: 超強新聞矩陣 + 產業API（2026終極，逐行保留）
@@ -2013,21 +3540,7 @@ raw_news_pool = []
 collected_sources = set()
 news_summary = ""
 news_emotion = 50
-try:
-    industry = st.session_state["industry"]
-    stock_code = st.session_state["stock_code"]
-    stock_name = st.session_state["stock_name"]
-except:
-    pass
-
-try:
-    prog.progress(50)
-except:
-    pass
-
-import feedparser
-import requests
-import pandas as pd
+prog.progress(50)
 
 # 🔥 15源RSS（完整保留）
 mega_rss_pool = {
@@ -2048,22 +3561,20 @@ mega_rss_pool = {
     "航運運價": "https://news.cnyes.com/rss/?keyword=SCFI"
 }
 
-for source_name, rss_url in mega_rss_pool.items():
-    try:
-        feed = feedparser.parse(rss_url)
-        collected_sources.add(source_name)
-        for entry in feed.entries[:8]:
-            title = entry.title.lower()
-            keywords = [stock_code, stock_name, industry, "營收", "財報", "外資"]
-            if any(kw.lower() in title for kw in keywords):
-                raw_news_pool.append({
-                    "title": entry.title[:100],
-                    "summary": entry.get("summary", "")[:150],
-                    "link": entry.link,
-                    "source": source_name
-                })
-    except:
-        pass
+try: mega_feeds = fetch_rss_feeds(mega_rss_pool)
+except Exception: mega_feeds = {}
+keywords = [stock_code, stock_name, industry, "營收", "財報", "外資"]
+for source_name, entries in mega_feeds.items():
+    collected_sources.add(source_name)
+    for entry in entries[:8]:
+        title = entry["title"].lower()
+        if any(kw.lower() in title for kw in keywords):
+            raw_news_pool.append({
+                "title": entry["title"][:100],
+                "summary": entry["summary"][:150],
+                "link": entry["link"],
+                "source": source_name
+            })
 
 # 🔥 產業API（完整）
 industry_apis = {}
@@ -2084,10 +3595,7 @@ news_summary = " ".join([f"{n['source']}:{n['title']}" for n in raw_news_pool])
 
 # st.caption(f"📰 超抓取：...")  # ← 註解
 
-try:
-    prog.progress(75)
-except:
-    pass
+prog.progress(75)
 
 # Groq強化（語法修復）
 try:
@@ -2119,7 +3627,7 @@ except:
 # 除錯（註解）
 # with st.expander("🔍 完整池+API（除錯）"):
 
-st.success(f"✅ 新聞收集完成（{len(raw_news_pool)}筆）")  # ← 只留這行
+research_notes.append(("success", f"✅ 新聞收集完成（{len(raw_news_pool)}筆）"))  # ← 只留這行
 
 st.session_state.news_summary = news_summary + " " + " ".join(industry_apis.values())
 st.session_state.final_industry = industry
@@ -2127,12 +3635,7 @@ st.session_state.final_industry = industry
 # =======================================================
 # Step C: 機構研究報告生成（融合三方→單篇報告）- 100%保留版
 # =======================================================
-status.info("📈 Step C: 生成機構級綜合研究報告")
-
-# C1. 防呆變數檢查（100%保留）
-if 'advanced_data' not in locals(): advanced_data = {}
-if 'price_snapshot' not in locals(): price_snapshot = {}
-if 'news_summary' not in locals(): news_summary = "新聞池準備中"
+# C1. 股價基準（只用在報告，不覆蓋頁首的大盤數值）
 S_current = price_snapshot.get('last_price', 0)
 ma20 = S_current * 0.95
 gap_pct = ((S_current - ma20) / ma20 * 100) if ma20 else 0
@@ -2236,7 +3739,7 @@ chip_text = fmt(advanced_data.get('foreign_chips'))
 pe_text = fmt(advanced_data.get('pe_ratio'))
 
 # C4. 🔥融合三方單篇Prompt（新架構）
-st.info("🧠 AI 綜合報告生成中（高盛+機構+對沖基金）...")
+prog.progress(85)
 
 # 三方融合 Prompt
 # C4. 三方融合 Prompt（動態版）
@@ -2301,7 +3804,7 @@ current_price = price_snapshot.get('last_price', 280)
 
 # 🔥 新增：產品資訊注入三方視角
 product_info = ""
-if advanced_data.get("revenue_segments"):
+if isinstance(advanced_data.get("revenue_segments"), list) and advanced_data["revenue_segments"]:
     segs = advanced_data["revenue_segments"][:2]
     seg1_name = segs[0].get('segment_name', '主力產品')
     seg1_rev = safe_num(segs[0].get('revenue', 0), 0)
@@ -2315,12 +3818,10 @@ if product_info:
     perspectives["inst"] = f"{product_info}貢獻{rev_text} | " + perspectives["inst"]
     perspectives["hedge"] += f" | {product_info}訂單"
 
-if st.session_state.t5_is_etf:
+if is_etf:
     # 🔥 最小改：僅動態成分股，其他用advanced_data備案
     try:
-        from FinMind.data import DataLoader
-        dl = DataLoader()
-        df = dl.taiwan_etf_composition(stock_id=stock_code)
+        df = etf_comp_df if etf_comp_df is not None else dl.taiwan_etf_composition(stock_id=stock_code)
         top_df = df.nlargest(2, 'holding_share')[['stock_name', 'holding_share']]  # 只top2改表
         etf_holdings = '、'.join([f"{row['stock_name']}{row['holding_share']:.1f}%" for _, row in top_df.iterrows()])
         holdings_table = f"|{'|'.join(top_df['stock_name'])}|\n|{'|'.join(f"{w:.1f}%" for w in top_df['holding_share'])}|"
@@ -2395,6 +3896,7 @@ else:
 ### Executive Summary(買入+3亮點含Capex20%) → 1)Micro-Metrics → 2)Variant(三方對比) → 3)Valuation → 4)Action(乖離>5%買入)"""
 
 groq_key = st.secrets.get("GROQ_KEY", "")
+combined_report = None
 if groq_key:
     try:
         from groq import Groq
@@ -2403,7 +3905,6 @@ if groq_key:
         
         # 多模型fallback（100%保留）
         models = ["llama3-70b-8192", "llama-3.1-8b-instant", "mixtral-8x7b-32768"]
-        combined_report = None
         
         for model in models:
             try:
@@ -2414,57 +3915,43 @@ if groq_key:
                     max_tokens=4500
                 )
                 combined_report = resp.choices[0].message.content
-                st.success(f"✅ Groq {model} 綜合報告成功生成")
+                research_notes.append(("success", f"✅ Groq {model} 綜合報告成功生成"))
                 break
             except:
                 continue
         
         if combined_report:
-            # 單篇報告展示（改進版）
-            clean_report = clean_md(combined_report)
-            
-            st.markdown("## 🏦 **綜合研究報告（三方融合）**")
-            st.markdown(clean_report)
-            st.download_button("📥 下載綜合報告", clean_report, f"{stock_code}_綜合報告.md")
-            
             st.session_state.t5_result = combined_report
-            
         else:
-            st.warning("⚠️ 模型暫忙，請稍後重試")
+            research_notes.append(("warning", "⚠️ 模型暫忙，請稍後重試"))
             
     except Exception as e:
-        st.error("❌ Groq 連線問題")
+        research_notes.append(("error", "❌ Groq 連線問題"))
 else:
-    st.warning("⚠️ 請設定 GROQ_KEY")
-
-# C6. 儀表板（100%保留）
-# 🔥 新增：產品營收組成儀表板
-if advanced_data.get("revenue_segments"):
-    st.markdown("#### 🧩 **產品營收組成**")
-    segments = advanced_data.get("revenue_segments", [])
-    
-    if isinstance(segments, list) and segments:
-        seg_cols = st.columns(min(3, len(segments)))
-        for i, seg in enumerate(segments[:3]):
-            with seg_cols[i]:
-                rev = safe_num(seg.get('revenue', 0), 0)
-                st.metric(
-                    f"**{seg.get('segment_name', 'N/A')}**", 
-                    f"{rev:,.0f}萬" if rev else "—"
-                )
-        st.caption(f"前三大占比：{advanced_data.get('top3_concentration', 'N/A')}")
-    else:
-        st.caption(advanced_data.get("key_products", "查詢中..."))
-    
-    st.divider()
-
-col1, col2, col3, col4 = st.columns(4)
-col1.metric("💰 現價", f"{price_snapshot.get('last_price', 0):,.0f}元")
-col2.metric("📈 乖離", f"{advanced_data.get('ma20_deviation', '0%')}")
-col3.metric("🏦 年配", f"{dividend_metrics.get('avg_div', 0):.2f}元")
-col4.metric("📊 P/E", f"{valuation.get('trailingPE', 'N/A')}")
+    research_notes.append(("warning", "⚠️ 請設定 GROQ_KEY"))
+
+# C6. 任務結果：寫入快取 + 顯示
+research_job = {
+    "stock_code": stock_code, "report": combined_report, "notes": research_notes,
+    "advanced_data": advanced_data, "price_snapshot": price_snapshot,
+    "dividend_metrics": dividend_metrics, "valuation": valuation,
+    "generated_at": datetime.now().strftime("%m/%d %H:%M"),
+    "state": {
+        "t5_stock_name": stock_name, "t5_industry": industry, "t5_is_etf": is_etf,
+        "t5_price_snapshot": price_snapshot, "t5_advanced_data": advanced_data,
+        "t5_dividend_metrics": dividend_metrics, "t5_valuation": valuation,
+        "t5_result": combined_report,
+        "news_summary": st.session_state.news_summary, "final_industry": industry,
+    },
+}
+# 模型全失敗時不快取，下次按鈕可以重試
+if combined_report:
+    research_cache.put(research_key, research_job)
+st.session_state["t5_job"] = research_job
 
-st.success("✅ Step C 綜合報告生成完成！")
+with tabs[0]:
+    prog.empty()
+    render_research_job(research_job)
 st.session_state.hide_valuation = True 
 st.stop() 
 
@@ -0,0 +1,54 @@
+"""
+多進程工作函式 (app.py 的 map_parallel 專用)。
+放在可匯入的獨立模組：forkserver / spawn 子進程依模組名稱載入，不會重跑 Streamlit 主腳本；
+所有參數由 task tuple 明確傳入，不依賴 app.py 的全域變數。
+"""
+import numpy as np
+import pandas as pd
+
+
+def simulate_month(task):
+    """單一合約月份：依每日結算價追蹤各筆進場，到期或觸發停利/停損/最長持有即出場。
+    資料最後一天仍早於到期日且未觸發出場者標為「未平倉」(以最新結算價評價，未實現)。
+    回傳 (trades, pnl_dates, pnl_values)，pnl 為每日市值變動 (元/口)；multiplier 為契約乘數 (TXO 50)。"""
+    path, picks, expiry, take_profit, stop_loss, max_hold, multiplier = task
+    expired = path.index[-1] >= expiry
+    dates, px_ = path.index.to_numpy(), path.to_numpy(float)
+    col = {k: j for j, k in enumerate(path.columns)}
+    trades, pnl_dates, pnl_vals = [], [], []
+    for p in picks.itertuples(index=False):
+        i0 = int(np.searchsorted(dates, p.date))
+        seg = px_[i0:, col[p.strike_price]].copy()
+        seg[0] = p.price
+        seg = pd.Series(seg).ffill().to_numpy()   # 進場後暫無結算價的日子沿用前值
+        ret = seg / p.price - 1
+        held = np.arange(seg.size)
+        hit = (ret >= take_profit) | (ret <= -stop_loss) | (held >= max_hold)
+        hit[0] = False
+        k = int(np.argmax(hit)) if hit.any() else seg.size - 1
+        reason = ("到期" if expired else "未平倉") if not hit.any() else ("停利" if ret[k] >= take_profit else ("停損" if ret[k] <= -stop_loss else "持有期滿"))
+        trades.append({"進場日": p.date, "合約": p.contract_date, "履約價": int(p.strike_price), "進場價": p.price,
+                       "槓桿": p.leverage, "勝率": p.win, "出場日": dates[i0 + k], "出場價": seg[k],
+                       "報酬": ret[k], "損益": (seg[k] - p.price) * multiplier, "原因": reason})
+        pnl_dates.append(dates[i0 + 1:i0 + k + 1])
+        pnl_vals.append(np.diff(seg[:k + 1]) * multiplier)
+    return trades, np.concatenate(pnl_dates) if pnl_dates else dates[:0], np.concatenate(pnl_vals) if pnl_vals else np.zeros(0)
+
+
+def mc_chunk(task):
+    """蒙地卡羅：模擬一塊路徑，只回傳每日對數淨值直方圖 counts[days, bins] (每塊約 n × days × 8 bytes 工作記憶體)。"""
+    model, rets, mu, sigma, block, n, days, seed, lo, width, bins = task
+    rng = np.random.Generator(np.random.PCG64(seed))
+    if model == "bootstrap":
+        block = max(1, min(int(block), rets.size))
+        n_blocks = -(-days // block)
+        starts = rng.integers(0, rets.size - block + 1, size=(n, n_blocks))
+        idx = (starts[:, :, None] + np.arange(block)).reshape(n, -1)[:, :days]
+        r = rets[idx]
+    else:
+        r = rng.standard_normal((n, days), dtype=np.float32) * np.float32(sigma) + np.float32(mu)
+    log_eq = np.cumsum(np.log1p(np.maximum(r, -0.99, dtype=np.float32)), axis=1, dtype=np.float32)
+    b = np.clip(((log_eq - lo) / width).astype(np.int64), 0, bins - 1)
+    flat = b + (np.arange(days) * bins)[None, :]
+    counts = np.bincount(flat.ravel(), minlength=days * bins).reshape(days, bins)
+    return counts